@@ -176,14 +176,38 @@ function CompressUrlLzstring(mzs, intensities) {
 }
 
 
+// local compression API (compression_service.py), its payloads are cached and shared with the app.
+// Only the untagged codec is requested: links point at the deployed viewer (liveURL), which may not know the
+// tagged (GZ:, FL:, I4:, I3:) codecs, and the lossy ones would change the spectrum.
+var compressionAPI = 'http://127.0.0.1:8000';
+
+async function compressSpectra(mzs, intensities) {
+    try {
+        const response = await fetch(compressionAPI + '/compress', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({mzs: mzs, intensities: intensities, codecs: ['']}),
+            signal: AbortSignal.timeout(2000),
+        });
+        if (response.ok) {
+            return (await response.json()).payload;
+        }
+    } catch (e) {
+        console.log('Compression API unavailable, using LZString: ' + e);
+    }
+    return CompressUrlLzstring(mzs, intensities);
+}
+
+
 const [mzArray, intensityArray] = splitPeaks(peaks);
 console.log(mzArray.length);
-const compressedData = CompressUrlLzstring(mzArray, intensityArray);
 const allMods = mergeArrays(mapModsByIndex(mysequence, staticMods), varMods)
 var modifiedSequence = addModifications(mysequence, allMods, ntermMod, ctermMod);
 
 var localURL = 'http://localhost:8501/'
 var liveURL = 'https://spectrum-viewer.streamlit.app/'
-var streamlitURL = createStreamlitLink(liveURL, modifiedSequence, compressedData);
-console.log(streamlitURL);
-addLinkToPage(streamlitURL);
+compressSpectra(mzArray, intensityArray).then(compressedData => {
+    var streamlitURL = createStreamlitLink(liveURL, modifiedSequence, compressedData);
+    console.log(streamlitURL);
+    addLinkToPage(streamlitURL);
+});
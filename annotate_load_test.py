@@ -0,0 +1,89 @@
+"""
+Load test of the annotation service: throughput and latency percentiles.
+
+    python annotate_service.py --processes 4 &
+    python annotate_load_test.py --requests 500 --concurrency 8
+    python annotate_load_test.py --requests 50 --batch-size 32
+
+Requests use the default sequence and spectrum with a jittered mass tolerance, so they are not answered from the
+service's response cache (pass --repeat to measure cached responses).
+"""
+
+import argparse
+import json
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+import constants
+from annotation_util import serialize_sequence
+
+
+def post_json(url: str, payload: dict, timeout: float) -> dict:
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def get_payload(index: int, batch_size: int, repeat: bool, include_figure: bool) -> dict:
+    spectra = serialize_sequence(constants.DEFAULT_SPECTRA)
+    psms = [
+        {
+            "sequence": constants.DEFAULT_SEQUENCE,
+            "spectra": spectra,
+            "mass_tolerance": 50.0 if repeat else 20.0 + ((index * batch_size + i) % 10_000) / 1000,
+        }
+        for i in range(batch_size)
+    ]
+    if batch_size == 1:
+        return {"psm": psms[0], "include_figure": include_figure}
+    return {"psms": psms, "include_figure": include_figure}
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the annotation service.")
+    parser.add_argument("--url", default=f"http://{constants.ANNOTATE_SERVICE_HOST}:{constants.ANNOTATE_SERVICE_PORT}")
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent clients")
+    parser.add_argument("--batch-size", type=int, default=1, help="PSMs per request (> 1 uses /annotate/batch)")
+    parser.add_argument("--include-figure", action="store_true", help="Request the figure JSON")
+    parser.add_argument("--repeat", action="store_true", help="Send identical requests (cached responses)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Request timeout in seconds")
+    args = parser.parse_args(argv)
+
+    endpoint = args.url.rstrip("/") + ("/annotate" if args.batch_size == 1 else "/annotate/batch")
+    payloads = [get_payload(i, args.batch_size, args.repeat, args.include_figure) for i in range(args.requests)]
+
+    def send(payload: dict):
+        start = time.perf_counter()
+        try:
+            post_json(endpoint, payload, args.timeout)
+            return time.perf_counter() - start, None
+        except Exception as err:
+            return time.perf_counter() - start, err
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(send, payloads))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, err in results if err is None]) * 1000
+    errors = [err for _, err in results if err is not None]
+    num_psms = len(latencies) * args.batch_size
+    print(f"{len(results)} requests ({len(errors)} failed), {num_psms} PSMs in {elapsed:.2f} s")
+    print(f"throughput: {len(latencies) / elapsed:.1f} requests/s, {num_psms / elapsed:.1f} PSMs/s")
+    if len(latencies) > 0:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"latency: p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, max {latencies.max():.1f} ms")
+    if errors:
+        print(f"first error: {errors[0]}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""
+Local HTTP annotation service (no browser needed).
+
+    python annotate_service.py --port 8001 --processes 4
+
+POST /annotate         {"psm": {...}, "params": {...}, "include_figure": false}
+POST /annotate/batch   {"psms": [{...}, ...], "params": {...}, "include_figure": false}
+GET  /health
+
+A PSM has the columns of batch_annotate.py's input table: 'sequence' plus 'spectra' text, 'mzs' and 'intensities'
+lists or 'file' and 'scan', and optionally per-PSM parameters. 'params' applies to every PSM of the request.
+'file' paths are resolved against the data directory (--data-dir, ANNOTATE_SERVICE_DATA_DIR) and must lie inside
+it; without a data directory 'file' PSMs are rejected.
+Each result holds the PSM's metrics, its match table (the matched rows of spectra_df) and, if requested, the
+plotly figure JSON. Annotation runs in a worker pool (recreated if a worker dies); fragments are cached per worker
+and responses without errors are cached (by request content) in the server process.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import peptacular as pt
+
+import constants
+from annotation_util import get_fragments
+from batch_annotate import INPUT_FIELDS, get_batch_inputs, get_psm_metrics, get_spectra_figure, run_annotation
+
+# spectra_df columns returned in the match table
+MATCH_TABLE_COLUMNS = ["mz", "intensity", "ion_label", "ion_type", "charge", "number", "isotope", "loss", "internal",
+                       "theo_mz", "error", "error_ppm"]
+
+
+@lru_cache(maxsize=256)
+def _get_cached_fragments(annotation_str: str, is_monoisotopic: bool, fragment_types: tuple, charges: tuple,
+                          isotopes: tuple, losses: tuple, immonium_ions: bool) -> list:
+    return get_fragments(pt.parse(annotation_str), is_monoisotopic, list(fragment_types), list(charges),
+                         list(isotopes), list(losses), immonium_ions)
+
+
+def get_worker_fragments(annotation: pt.ProFormaAnnotation, is_monoisotopic: bool, fragment_types: list,
+                         charges: list, isotopes: list, losses: list, immonium_ions: bool) -> list:
+    """get_fragments, cached in the worker process (the same peptide is often annotated many times)."""
+    return _get_cached_fragments(annotation.serialize(), is_monoisotopic, tuple(fragment_types), tuple(charges),
+                                 tuple(isotopes), tuple(losses), immonium_ions)
+
+
+def annotate_psm_json(psm: Dict[str, Any], params: Dict[str, Any], include_figure: bool = False) -> Dict[str, Any]:
+    """
+    Annotate a single PSM of a request. Errors are reported in the 'error' field.
+
+    :param psm: The PSM (sequence, spectrum and per-PSM parameters).
+    :param params: Parameters applied to the PSM (overridden by the PSM's own).
+    :param include_figure: Add the annotated spectrum's plotly figure JSON.
+    :return: JSON serializable result: sequence, error, metrics, matches and optionally figure.
+    """
+    result = {"sequence": psm.get("sequence"), "error": None}
+    try:
+        inputs = get_batch_inputs(psm, params)
+        annotation, fragments, fragment_matches, spectra_df = run_annotation(inputs, get_worker_fragments)
+
+        metrics = {"mass": pt.mass(annotation)}
+        metrics.update(get_psm_metrics(inputs, fragments, fragment_matches, spectra_df))
+        # NaN (e.g. the error stats without matches) is not valid JSON
+        result["metrics"] = {key: None if isinstance(value, float) and math.isnan(value) else value
+                             for key, value in metrics.items()}
+
+        match_df = spectra_df.loc[spectra_df["matched"], MATCH_TABLE_COLUMNS]
+        result["matches"] = json.loads(match_df.to_json(orient="records"))
+
+        if include_figure:
+            result["figure"] = json.loads(get_spectra_figure(inputs, spectra_df).to_json())
+    except Exception as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+    return result
+
+
+def _annotate_chunk(psms: List[Dict[str, Any]], params: Dict[str, Any], include_figure: bool) -> list:
+    return [annotate_psm_json(psm, params, include_figure) for psm in psms]
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of responses, keyed by the request's content."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class AnnotateService:
+    """The service's shared state: the worker pool, the response cache and the data directory of 'file' PSMs."""
+
+    def __init__(self, processes: int = constants.ANNOTATE_SERVICE_WORKERS,
+                 cache_size: int = constants.ANNOTATE_SERVICE_CACHE_SIZE,
+                 timeout: float = constants.ANNOTATE_SERVICE_TIMEOUT, chunk_size: int = 16,
+                 data_dir: str = constants.ANNOTATE_SERVICE_DATA_DIR):
+        self.executor = ProcessPoolExecutor(processes)
+        self.processes = processes
+        self.cache = ResponseCache(cache_size)
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.data_dir = os.path.realpath(data_dir) if data_dir else None
+        self._executor_lock = threading.Lock()
+
+    def resolve_file(self, path: str) -> str:
+        """
+        Resolve a PSM's 'file' against the data directory.
+
+        :param path: The file, relative to the data directory (or absolute, inside it).
+        :return: The file's real path.
+        :raises ValueError: If no data directory is configured or the file is outside of it.
+        """
+        if self.data_dir is None:
+            raise ValueError("'file' PSMs are not enabled (no data directory is configured)")
+        resolved = os.path.realpath(os.path.join(self.data_dir, path))
+        if os.path.commonpath([self.data_dir, resolved]) != self.data_dir:
+            raise ValueError(f"File is outside of the data directory: {path}")
+        return resolved
+
+    def _replace_executor(self, broken: ProcessPoolExecutor) -> None:
+        # concurrent requests see the same broken pool, only the first one replaces it
+        with self._executor_lock:
+            if self.executor is broken:
+                self.executor = ProcessPoolExecutor(self.processes)
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def annotate(self, psms: List[Dict[str, Any]], params: Dict[str, Any], include_figure: bool) -> list:
+        """
+        Annotate PSMs in the worker pool.
+
+        If a worker dies the pool is replaced and the PSMs are submitted once more, a BrokenProcessPool is raised
+        if that fails too.
+        """
+        # spread the PSMs over all workers, at most chunk_size PSMs per task
+        chunk_size = max(1, min(self.chunk_size, -(-len(psms) // self.processes)))
+        chunks = [psms[i:i + chunk_size] for i in range(0, len(psms), chunk_size)]
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                futures = [executor.submit(_annotate_chunk, chunk, params, include_figure) for chunk in chunks]
+                return [result for future in futures for result in future.result(self.timeout)]
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                if attempt:
+                    raise
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def _validate_params(params: Any) -> Dict[str, Any]:
+    if not isinstance(params, dict):
+        raise ValueError("'params' must be an object")
+    unknown = sorted(set(params) - INPUT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(unknown)}")
+    return params
+
+
+class AnnotateRequestHandler(BaseHTTPRequestHandler):
+    service: AnnotateService = None
+
+    def _send_json(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_json(self, status: int, message: str):
+        self._send_json(status, json.dumps({"error": message}).encode())
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, b'{"status": "ok"}')
+        else:
+            self._send_error_json(404, f"Unknown endpoint: {self.path}")
+
+    def do_POST(self):
+        if self.path not in ("/annotate", "/annotate/batch"):
+            self._send_error_json(404, f"Unknown endpoint: {self.path}")
+            return
+
+        raw_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        cache_key = hashlib.blake2b(self.path.encode() + b"\0" + raw_body, digest_size=16).hexdigest()
+        cached = self.service.cache.get(cache_key)
+        if cached is not None:
+            self._send_json(200, cached)
+            return
+
+        try:
+            request = json.loads(raw_body)
+            if not isinstance(request, dict):
+                raise ValueError("The request body must be a JSON object")
+            params = _validate_params(request.get("params", {}))
+            include_figure = bool(request.get("include_figure", False))
+            if self.path == "/annotate":
+                psms = [request["psm"]]
+            else:
+                psms = request["psms"]
+            if not isinstance(psms, list) or not all(isinstance(psm, dict) for psm in psms):
+                raise ValueError("PSMs must be objects")
+            psms = [{**psm, "file": self.service.resolve_file(psm["file"])} if isinstance(psm.get("file"), str)
+                    else psm for psm in psms]
+        except (ValueError, KeyError) as err:
+            self._send_error_json(400, f"Invalid request: {err}")
+            return
+
+        try:
+            results = self.service.annotate(psms, params, include_figure)
+        except TimeoutError:
+            self._send_error_json(504, "Annotation timed out")
+            return
+        except BrokenProcessPool:
+            self._send_error_json(503, "Annotation workers crashed, retry the request")
+            return
+
+        body = json.dumps(results[0] if self.path == "/annotate" else {"results": results}).encode()
+        # errors may be transient (e.g. a spectra file being written), don't replay them
+        if all(result["error"] is None for result in results):
+            self.service.cache.put(cache_key, body)
+        self._send_json(200, body)
+
+    def log_message(self, format, *args):
+        # one line per request is too much under load
+        pass
+
+
+def serve(host: str = constants.ANNOTATE_SERVICE_HOST, port: int = constants.ANNOTATE_SERVICE_PORT,
+          processes: int = constants.ANNOTATE_SERVICE_WORKERS,
+          data_dir: str = constants.ANNOTATE_SERVICE_DATA_DIR) -> None:
+    service = AnnotateService(processes, data_dir=data_dir)
+    handler = type("Handler", (AnnotateRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Annotation service on http://{host}:{port} ({processes} workers, "
+          f"data directory: {service.data_dir or 'none'})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the local HTTP annotation service.")
+    parser.add_argument("--host", default=constants.ANNOTATE_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=constants.ANNOTATE_SERVICE_PORT)
+    parser.add_argument("--processes", type=int, default=constants.ANNOTATE_SERVICE_WORKERS,
+                        help="Number of worker processes")
+    parser.add_argument("--data-dir", default=constants.ANNOTATE_SERVICE_DATA_DIR,
+                        help="Directory of the spectra files 'file' PSMs may read (default: 'file' PSMs are rejected)")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.processes, args.data_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
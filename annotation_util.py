@@ -0,0 +1,776 @@
+"""
+Streamlit-free annotation core: spectrum parsing and processing, fragment generation, fragment matching and
+building the spectra DataFrame. The app (app_input.py, util.py) and batch_annotate.py build on top of this module.
+"""
+
+import hashlib
+import io
+import math
+import re
+import warnings
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import peptacular as pt
+
+import constants
+from spectra_util import centroid_spectra, deconvolute_spectra, retain_peaks
+
+
+@dataclass
+class SpectraInputs:
+    """Dataclass to store all spectra viewer inputs."""
+    # Sequence parameters
+    sequence: str
+    
+    # Mass tolerance parameters
+    mass_tolerance_type: str
+    mass_tolerance: float
+    
+    # Charge parameters
+    min_charge: int
+    max_charge: int
+    
+    # Spectra data
+    spectra_text: str
+    
+    # Fragment parameters
+    fragment_types: List[str]
+    immonium_ions: bool
+    mass_type: str
+    peak_assignment: str
+    
+    # Isotope parameters
+    num_isotopes: int
+    filter_missing_mono: bool
+    filter_interrupted_iso: bool
+    
+    # Plot parameters
+    y_axis_scale: str
+    hide_unassigned_peaks: bool
+    min_mz: float
+    max_mz: float
+    min_intensity_type: str
+    min_intensity: float
+    max_intensity_type: str
+    max_intensity: float
+    line_width: float
+    text_size: float
+    marker_size: float
+    axis_text_size: float
+    title_text_size: float
+    tick_text_size: float
+    fig_width: float
+    fig_height: float
+    hide_error_percentile_labels: bool
+    bold_labels: bool
+    color_dict: dict[str, str]
+    
+    # Neutral loss parameters
+    h2o_loss: bool
+    nh3_loss: bool
+    h3po4_loss: bool
+    custom_loss_str: str
+
+    #deconvolution parameters
+    deconvolute: bool
+    deconvolute_error_type: str
+    deconvolute_error: float
+
+    # peak picking (centroiding) parameters
+    peak_picker: bool
+    peak_picker_min_intensity: float
+    peak_picker_mass_tolerance: float
+
+    # peak retention parameters
+    top_n_peaks: int
+    bottom_n_peaks: int
+    peak_window: float
+
+    stateful: bool = True
+
+    # already decoded spectra (an uploaded file's scan or the permalink's payload), takes precedence over spectra_text
+    spectra_source: str = ""
+    spectra_arrays: Optional[Tuple[np.ndarray, np.ndarray]] = field(default=None, compare=False, repr=False)
+
+    @property
+    def custom_losses(self) -> dict[str, float]:
+
+        if self.custom_loss_str:
+            return {
+                nl.split(":")[0]: float(nl.split(":")[1])
+                for nl in self.custom_loss_str.split(";")
+            }
+        else:
+            return {}
+    
+    @property
+    def neutral_losses(self) -> dict[str, float]:
+        losses = {}
+        if self.h2o_loss:
+            losses['[STED]'] = -18.01056
+        if self.nh3_loss:
+            losses['[RKNQ]'] = -17.02655
+        if self.h3po4_loss:
+            losses['[ST]'] = -97.9769
+
+        losses.update(self.custom_losses)
+
+        return losses
+    
+    @property
+    def losses(self) -> list[tuple[str, float]]:
+        return list(self.neutral_losses.items()) + list(self.custom_losses.items())
+    
+    @property
+    def ion_types(self) -> list[str]:
+        return [
+            f"{f}{c}"
+            for f in self.fragment_types
+            for c in range(self.min_charge, self.max_charge + 1)
+        ]
+
+    @property
+    def spectra_processing_params(self) -> tuple:
+        """Every parameter the processed spectrum depends on (besides the input spectrum itself)."""
+        return (self.peak_picker, self.peak_picker_min_intensity, self.peak_picker_mass_tolerance,
+                self.min_mz, self.max_mz, self.min_intensity_type, self.min_intensity, self.max_intensity_type,
+                self.max_intensity, self.top_n_peaks, self.bottom_n_peaks, self.peak_window,
+                self.deconvolute, self.deconvolute_error_type, self.deconvolute_error, self.min_charge, self.max_charge)
+
+    @cached_property
+    def spectra_key(self) -> str:
+        """Content hash of the input spectrum and its processing parameters."""
+        h = hashlib.blake2b(digest_size=16)
+        if self.spectra_arrays is not None:
+            h.update(get_spectra_fingerprint(*self.spectra_arrays).encode())
+        else:
+            h.update(self.spectra_text.encode())
+        h.update(repr(self.spectra_processing_params).encode())
+        return h.hexdigest()
+
+    @cached_property
+    def spectra(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Filtered (and optionally deconvoluted) m/z and intensity arrays."""
+        return self.process_spectra()
+
+    def process_spectra(self, deconvolute: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """Run the spectrum pipeline: parse, peak pick, filter, retain top/bottom peaks and deconvolute."""
+
+        if self.spectra_arrays is not None:
+            mzs, intensities = self.spectra_arrays
+        else:
+            mzs, intensities = parse_spectra(self.spectra_text)
+
+        if self.peak_picker:
+            mzs, intensities = centroid_spectra(mzs, intensities,
+                                                mass_tolerance=self.peak_picker_mass_tolerance,
+                                                min_intensity=self.peak_picker_min_intensity)
+
+        # filter: all thresholds are combined into a single mask
+        max_intensity = intensities.max() if len(intensities) > 0 else 0.0
+        min_intensity = self.min_intensity / 100 * max_intensity if self.min_intensity_type == "relative" \
+            else self.min_intensity
+        max_intensity = self.max_intensity / 100 * max_intensity if self.max_intensity_type == "relative" \
+            else self.max_intensity
+
+        mask = (intensities >= min_intensity) & (intensities <= max_intensity)
+
+        if self.min_mz:
+            mask &= mzs >= self.min_mz
+
+        if self.max_mz:
+            mask &= mzs <= self.max_mz
+
+        mzs, intensities = mzs[mask], intensities[mask]
+
+        mzs, intensities = retain_peaks(mzs, intensities, self.top_n_peaks, self.bottom_n_peaks, self.peak_window)
+
+        if deconvolute and self.deconvolute:
+            mzs, intensities = self.deconvolute_spectra(mzs, intensities)
+
+        return mzs, intensities
+
+    def deconvolute_spectra(self, mzs: np.ndarray, intensities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Deconvolute a (processed) spectrum with the deconvolution parameters."""
+        return deconvolute_spectra(mzs, intensities, self.deconvolute_error, self.deconvolute_error_type,
+                                   (self.min_charge, self.max_charge), timeout=constants.DECONVOLUTION_TIMEOUT,
+                                   processes=constants.DECONVOLUTION_WORKERS)
+
+    @cached_property
+    def min_spectra_mz(self):
+        return float(self.mz_values.min())
+
+    @cached_property
+    def max_spectra_mz(self):
+        return float(self.mz_values.max())
+    
+    @cached_property
+    def min_spectra_intensity(self):
+        return float(self.intensity_values.min())
+    
+    @cached_property
+    def max_spectra_intensity(self):
+        return float(self.intensity_values.max())
+    
+    @property
+    def num_peaks(self) -> int:
+        return len(self.mz_values)
+
+    @property
+    def mz_values(self) -> np.ndarray:
+        return self.spectra[0]
+    
+    @property
+    def intensity_values(self) -> np.ndarray:
+        return self.spectra[1]
+
+    @property
+    def mz_int_values(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.spectra
+    
+    
+    def get_color(self, ion: str, charge: int) -> str:
+        """Get color for a specific ion and charge."""
+
+        if ion is None or charge is None:
+            return self.color_dict['unassigned']
+
+        color_key = f'{"+" * charge}{ion}'
+        if color_key in self.color_dict:
+            return self.color_dict[color_key]
+        else:
+            return self.color_dict['unassigned']
+
+    
+    @property
+    def charges(self) -> list[int]:
+        return [
+            c
+            for c in range(self.min_charge, self.max_charge + 1)
+        ]
+    
+
+    @property
+    def unmodified_sequence(self) -> str:
+        return pt.strip_mods(self.sequence)
+
+    @property
+    def is_monoisotopic(self) -> bool:
+        return self.mass_type == "monoisotopic"
+
+    @property
+    def isotopes(self) -> list[int]:
+        return list(range(self.num_isotopes + 1))
+
+    @property
+    def peak_assignment_type(self) -> str:
+        return "largest" if self.peak_assignment == "most intense" else "closest"
+
+
+# comments run from '#' to the end of the line
+_COMMENT_PATTERN = re.compile(r"#[^\n]*")
+_NUMBER_PATTERN = re.compile(r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+
+# bytes that may appear inside a number field
+_NUMBER_BYTES = np.zeros(256, dtype=bool)
+_NUMBER_BYTES[list(b"0123456789.eE+-")] = True
+
+
+def _find_invalid_spectra_line(input_str: str) -> str:
+    """Return a description of the first line that cannot be parsed as 'mz intensity'."""
+    for line_number, line in enumerate(input_str.split("\n"), start=1):
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) != 2:
+            return f"line {line_number}: expected 2 values (mz intensity), got {len(parts)}: {line.strip()!r}"
+        if not all(_NUMBER_PATTERN.fullmatch(p) for p in parts):
+            return f"line {line_number}: invalid number in {line.strip()!r}"
+        if not all(math.isfinite(float(p)) for p in parts):
+            return f"line {line_number}: non-finite value in {line.strip()!r}"
+    return "unknown line"
+
+
+def parse_spectra(input_str: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parse a block of 'mz intensity' lines into m/z and intensity arrays.
+
+    Fields may be separated by any mix of spaces, tabs and commas. Blank lines and '#' comments are ignored.
+    Raises a ValueError naming the offending line number if the text cannot be parsed.
+    """
+
+    if not input_str:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+
+    text = input_str.replace(",", " ")
+    if "#" in text:
+        text = _COMMENT_PATTERN.sub("", text)
+
+    # count the fields on every line directly on the bytes: each line must be blank or hold exactly 2 fields
+    chars = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    is_space = chars <= 32
+    field_starts = np.flatnonzero(~is_space & np.concatenate(([True], is_space[:-1])))
+    newlines = np.flatnonzero(chars == 10)
+    fields_per_line = np.bincount(np.searchsorted(newlines, field_starts), minlength=len(newlines) + 1)
+    bad_lines = np.flatnonzero((fields_per_line != 0) & (fields_per_line != 2))
+    if len(bad_lines) > 0:
+        line_number = bad_lines[0] + 1
+        line = text.split("\n")[bad_lines[0]].strip()
+        raise ValueError(f"Invalid spectra input, line {line_number}: expected 2 values (mz intensity), "
+                         f"got {fields_per_line[bad_lines[0]]}: {line!r}")
+
+    # only blank lines and comments
+    if len(field_starts) == 0:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+
+    if not _NUMBER_BYTES[chars[~is_space]].all():
+        raise ValueError(f"Invalid spectra input, {_find_invalid_spectra_line(text)}")
+
+    # fromstring stops (with a warning) at the first token it cannot parse, which shows up as a short result, but
+    # the unparsed tail of the last token is dropped silently ('5e' reads as 5), so that token is checked strictly
+    last_field = text[field_starts[-1]:].split(None, 1)[0]
+    if not _NUMBER_PATTERN.fullmatch(last_field):
+        raise ValueError(f"Invalid spectra input, {_find_invalid_spectra_line(text)}")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(text, dtype=np.float64, sep=" ")
+
+    if len(values) != len(field_starts) or not np.isfinite(values).all():
+        raise ValueError(f"Invalid spectra input, {_find_invalid_spectra_line(text)}")
+
+    values = values.reshape(-1, 2)
+    return values[:, 0].copy(), values[:, 1].copy()
+
+
+def get_spectra_fingerprint(mzs: np.ndarray, intensities: np.ndarray) -> str:
+    """Content hash of a spectrum's arrays."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(mzs, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(intensities, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def parse_sequence(input_str: str) -> List[Tuple[float, float]]:
+    """Parse sequence string into list of mz and intensity tuples."""
+    mzs, intensities = parse_spectra(input_str)
+    return list(zip(mzs.tolist(), intensities.tolist()))
+
+
+RAW_SPECTRA_PREFIX = "RAW:"
+
+
+def decode_raw_spectra(input_str: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode the 'RAW:mz:intensity;mz:intensity;...' URL format into m/z and intensity arrays."""
+
+    body = input_str[len(RAW_SPECTRA_PREFIX):]
+    if not body:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+
+    chars = np.frombuffer(body.encode("utf-8"), dtype=np.uint8)
+    is_colon, is_semicolon = chars == ord(":"), chars == ord(";")
+    num_peaks = int(is_semicolon.sum()) + 1
+    if not (_NUMBER_BYTES[chars] | is_colon | is_semicolon).all():
+        raise ValueError("Invalid RAW spectra: expected 'mz:intensity' pairs separated by ';'")
+
+    # every ';' separated segment holds exactly one ':' (equal totals alone accept '1:2:3;4')
+    colon_segments = np.cumsum(is_semicolon)[is_colon]
+    if not (np.bincount(colon_segments, minlength=num_peaks) == 1).all():
+        raise ValueError("Invalid RAW spectra: expected 'mz:intensity' pairs separated by ';'")
+
+    # as in parse_spectra, fromstring drops the unparsed tail of the last value silently ('1:5e' reads as 1, 5)
+    if not _NUMBER_PATTERN.fullmatch(body[body.rfind(":") + 1:]):
+        raise ValueError("Invalid RAW spectra: expected 'mz:intensity' pairs separated by ';'")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(body.replace(";", ":"), dtype=np.float64, sep=":")
+
+    if len(values) != 2 * num_peaks or not np.isfinite(values).all():
+        raise ValueError("Invalid RAW spectra: expected 'mz:intensity' pairs separated by ';'")
+
+    values = values.reshape(-1, 2)
+    return values[:, 0].copy(), values[:, 1].copy()
+
+
+def encode_raw_spectra(mzs: np.ndarray, intensities: np.ndarray) -> str:
+    """Encode m/z and intensity arrays into the 'RAW:mz:intensity;...' URL format (full float precision)."""
+    values = np.column_stack((mzs, intensities)).astype(np.float64).ravel().tolist()
+    return RAW_SPECTRA_PREFIX + ("%r:%r;" * len(mzs) % tuple(values))[:-1]
+
+
+def serialize_sequence(sequence: List[Tuple[float, float]]) -> str:
+    """Convert list of mz and intensity tuples to string format."""
+    return "\n".join(f"{round(s[0], 5)} {round(s[1], 2)}" for s in sequence)
+
+
+def get_fragments(annotation: pt.ProFormaAnnotation,
+                  is_monoisotopic: bool,
+                  fragment_types: list[str],
+                  charges: list[int],
+                  isotopes: list[int],
+                  losses: list[(str, float)],
+                  immonium_ions: bool) -> list[pt.Fragment]:
+    fragments = pt.fragment(
+        sequence=annotation,
+        ion_types=fragment_types,
+        charges=charges,
+        monoisotopic=is_monoisotopic,
+        isotopes=isotopes,
+        losses=losses,
+    )
+
+    if immonium_ions:
+        fragmenter = pt.Fragmenter(annotation, is_monoisotopic)
+        fragments.extend(
+            fragmenter.fragment(
+                ion_types=["i"],
+                charges=[1],
+                isotopes=isotopes,
+                losses=losses,
+            )
+        )
+
+    return fragments
+
+
+@dataclass(frozen=True)
+class IndexedFragmentMatch(pt.FragmentMatch):
+    """FragmentMatch that also records the index of the matched peak in params.spectra."""
+    peak_index: int
+
+
+def match_fragments(fragments: list[pt.Fragment], mzs: np.ndarray, ints: np.ndarray, tolerance_value: float,
+                    tolerance_type: str = "ppm", mode: str = "closest") -> list[IndexedFragmentMatch]:
+    """
+    Vectorized equivalent of pt.get_fragment_matches that keeps the index of the matched peak.
+
+    :param fragments: Theoretical fragments.
+    :param mzs: Peak m/z values (any order).
+    :param ints: Peak intensities.
+    :param tolerance_value: Matching tolerance.
+    :param tolerance_type: 'ppm' or 'th'.
+    :param mode: 'closest', 'largest' or 'all'.
+    :return: One match per fragment (or per fragment/peak pair for 'all').
+    """
+    if tolerance_type not in ["ppm", "th"]:
+        raise ValueError('Invalid tolerance type. Must be "ppm" or "th"')
+
+    if mode not in ["all", "closest", "largest"]:
+        raise ValueError('Invalid mode. Must be "all", "closest" or "largest"')
+
+    if len(fragments) == 0 or len(mzs) == 0:
+        return []
+
+    frag_mzs = np.fromiter((f.mz for f in fragments), dtype=np.float64, count=len(fragments))
+    tolerance = np.full_like(frag_mzs, tolerance_value) if tolerance_type == "th" else frag_mzs * tolerance_value / 1e6
+
+    order = np.argsort(mzs, kind="stable")
+    sorted_mzs = mzs[order]
+    lo = np.searchsorted(sorted_mzs, frag_mzs - tolerance, side="left")
+    hi = np.searchsorted(sorted_mzs, frag_mzs + tolerance, side="right")
+
+    # expand every fragment into its candidate peaks (positions in sorted order)
+    counts = hi - lo
+    frag_idx = np.repeat(np.arange(len(fragments)), counts)
+    pos = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    if mode != "all":
+        if mode == "closest":
+            score = np.abs(sorted_mzs[pos] - frag_mzs[frag_idx])
+        else:
+            score = -ints[order[pos]]
+        best = np.lexsort((pos, score, frag_idx))
+        first = np.ones(len(best), dtype=bool)
+        first[1:] = frag_idx[best][1:] != frag_idx[best][:-1]
+        frag_idx, pos = frag_idx[best][first], pos[best][first]
+
+    peak_idx = order[pos]
+    return [
+        IndexedFragmentMatch(fragments[f], mzs[p].item(), ints[p].item(), p.item())
+        for f, p in zip(frag_idx, peak_idx)
+    ]
+
+
+def get_fragment_matches(params: SpectraInputs, fragments: list[pt.Fragment]) -> list[IndexedFragmentMatch]:
+    mzs, ints = params.mz_int_values
+
+    # TODO: Add priority to fragment matches, a random isotope match should not be better than a non-isotope match
+    fragment_matches = match_fragments(
+        fragments,
+        mzs,
+        ints,
+        params.mass_tolerance,
+        params.mass_tolerance_type,
+        params.peak_assignment_type,
+    )
+    fragment_matches.sort(key=lambda x: abs(x.error), reverse=True)
+
+    if params.filter_missing_mono:
+        fragment_matches = pt.filter_missing_mono_isotope(fragment_matches)
+
+    if params.filter_interrupted_iso:
+        fragment_matches = pt.filter_skipped_isotopes(fragment_matches)
+
+    return fragment_matches
+
+
+def get_match_cov(fragment_matches: list[pt.FragmentMatch]):
+    return pt.get_match_coverage(fragment_matches)
+
+
+# Compact schema for spectra_df. m/z values stay float64, everything that is only displayed is downcast.
+# number is a category instead if internal fragments (numbered '<start>-<end>') are matched.
+SPECTRA_DF_DTYPES = {
+    "mz": "float64",
+    "intensity": "float32",
+    "error": "float32",
+    "error_ppm": "float32",
+    "charge": "Int8",
+    "ion_type": "category",
+    "start": "Int16",
+    "end": "Int16",
+    "monoisotopic": "boolean",
+    "isotope": "Int8",
+    "loss": "float32",
+    "sequence": "category",
+    "theo_mz": "float64",
+    "internal": "boolean",
+    "label": "category",
+    "number": "Int16",
+    "abs_error": "float32",
+    "abs_error_ppm": "float32",
+    "ion_group_label": "category",
+    "ion_label": "category",
+    "color": "category",
+    "matched": "bool",
+}
+
+
+MATCH_COLUMNS = ["error", "error_ppm", "charge", "ion_type", "start", "end", "monoisotopic", "isotope", "loss",
+                 "sequence", "theo_mz", "internal", "label", "number"]
+
+
+def get_match_df(fragment_matches: list[IndexedFragmentMatch]) -> pd.DataFrame:
+    """Build a column-oriented table of fragment matches (one row per match)."""
+    data = {"peak_index": np.array([fm.peak_index for fm in fragment_matches], dtype=np.int64)}
+    for col in MATCH_COLUMNS:
+        data[col] = [getattr(fm, col) for fm in fragment_matches]
+    return pd.DataFrame(data)
+
+
+def get_spectra_df(params: SpectraInputs, fragment_matches: list[IndexedFragmentMatch]) -> pd.DataFrame:
+    mzs, ints = params.mz_int_values
+
+    match_df = get_match_df(fragment_matches)
+    for col in ["charge", "start", "end", "isotope"]:
+        match_df[col] = match_df[col].astype("Int64")
+
+    # internal fragments are numbered by their span ('3-17'), number is only integer if there are none
+    dtypes = SPECTRA_DF_DTYPES
+    if all(isinstance(n, (int, np.integer)) for n in match_df["number"]):
+        match_df["number"] = match_df["number"].astype("Int64")
+    else:
+        match_df["number"] = match_df["number"].astype(str)
+        dtypes = {**SPECTRA_DF_DTYPES, "number": "category"}
+
+    # keep the best fragment match (smallest absolute error) for each peak
+    match_df["abs_error"] = match_df["error"].abs()
+    match_df["abs_error_ppm"] = match_df["error_ppm"].abs()
+    match_df = match_df.sort_values("abs_error", kind="stable").drop_duplicates("peak_index")
+    match_df = match_df.set_index("peak_index")
+
+    # labels and colors only need to be built for matched peaks
+    # {charge}{ion_type}
+    match_df["ion_group_label"] = match_df["charge"].astype(str) + match_df["ion_type"]
+
+    # {charge}{ion_type}{number}{[isotope]}{(loss)}
+    isotope_str = ("[" + match_df["isotope"].astype(str) + "]").where(match_df["isotope"] != 0, "")
+    loss_str = ("(" + match_df["loss"].astype(str) + ")").where(match_df["loss"] != 0, "")
+    match_df["ion_label"] = match_df["ion_group_label"] + match_df["number"].astype(str) + isotope_str + loss_str
+
+    # Assigning colors based on color labels (one lookup per ion group rather than per peak)
+    groups = match_df[["ion_group_label", "ion_type", "charge"]].drop_duplicates("ion_group_label")
+    group_colors = {g: params.get_color(i, c) for g, i, c in groups.itertuples(index=False)}
+    match_df["color"] = match_df["ion_group_label"].map(group_colors)
+    match_df["matched"] = True
+
+    spectra_df = pd.DataFrame({"mz": mzs, "intensity": ints}).join(match_df)
+    spectra_df["matched"] = spectra_df["matched"].notna()
+    spectra_df["ion_label"] = spectra_df["ion_label"].fillna("")
+    spectra_df["ion_group_label"] = spectra_df["ion_group_label"].fillna("unassigned")
+    spectra_df["color"] = spectra_df["color"].fillna(params.get_color(None, None))
+
+    if params.hide_unassigned_peaks:
+        spectra_df = spectra_df[spectra_df["matched"]]
+
+    return spectra_df.astype(dtypes).reset_index(drop=True)
+
+
+def get_fragment_match_table(params: SpectraInputs, spectra_df: pd.DataFrame, frag_df: pd.DataFrame) -> pd.DataFrame:
+    dfs = []
+    # combined_data = {'AA': list(unmodified_sequence)}
+    combined_data = {"AA": pt.split(params.sequence)}
+    for ion in params.fragment_types:
+        for charge in params.charges:
+            data = {"AA": pt.split(params.sequence)}
+            ion_df = frag_df.copy()
+            ion_df = ion_df[
+                (ion_df["ion_type"] == ion)
+                & (ion_df["charge"] == charge)
+                & (ion_df["internal"] == False)
+                & (ion_df["isotope"] == 0)
+                & (ion_df["loss"] == 0)
+                ]
+            ion_df.sort_values(
+                by=["start"] if ion in "xyz" else ["end"],
+                inplace=True,
+                ascending=False if ion in "xyz" else True,
+            )
+
+            # keep only a single number
+            ion_df.drop_duplicates(
+                subset=["start"] if ion in "xyz" else ["end"], inplace=True
+            )
+
+            frags = ion_df["mz"].tolist()
+
+            if ion in "xyz":
+                frags = frags[::-1]
+
+            data[ion] = frags
+
+            combined_data[f"{charge}{ion}"] = frags
+
+            # Displaying the table
+            df = pd.DataFrame(data)
+            df["# (abc)"] = list(range(1, len(df) + 1))
+            df["# (xyz)"] = list(range(1, len(df) + 1))[::-1]
+
+            # reorder columns so that # is first # +1 is last and AA is in the middle
+            df = df[
+                ["AA"]
+                + ["# (abc)"]
+                + [col for col in df.columns if col not in ["AA", "# (abc)", "# (xyz)"]]
+                + ["# (xyz)"]
+                ]
+            dfs.append(df)
+
+
+    combined_df = pd.DataFrame(combined_data)
+    # sort columns based on alphabetical order
+    combined_df = combined_df.reindex(sorted(combined_df.columns), axis=1)
+
+    def highlight_cells(data):
+        # Initialize empty DataFrame with same index and columns as original
+        styled = pd.DataFrame("", index=data.index, columns=data.columns)
+
+        # Iterate over cells and update `styled` based on cell position
+        for row in data.index:
+            for col in data.columns:
+                if col == "AA" or col == "# (abc)" or col == "# (xyz)":
+                    styled.loc[row, col] = (
+                        f"background-color: gainsboro; color: black; text-align: center; font-weight: bold;"
+                    )
+                    continue
+
+                ion = col[-1]
+                charge = int(col[:-1])
+                if ion in "abc":
+                    ion_number = row + 1
+                else:
+                    ion_number = len(params.unmodified_sequence) - row
+                ion_key = col + str(ion_number)
+                mz = data.loc[row, col]
+
+                if mz <= params.min_mz or mz >= params.max_mz:
+                    styled.loc[row, col] = (
+                        f"background-color: #BEBEBE; color: black; text-align: center; font-weight: bold;"
+                    )
+                else:
+                    if ion_key in accepted_normal_ions:
+                        styled.loc[row, col] = (
+                            f"background-color: {params.get_color(ion, charge)}; color: white; text-align: center; font-weight: bold;"
+                        )
+                    elif ion_key in accepted_internal_ions:
+                        styled.loc[row, col] = (
+                            f"background-color: {params.get_color(ion, charge)}; color: magenta; text-align: center; font-style: italic; font-weight: bold;"
+                        )
+                    else:
+                        styled.loc[row, col] = (
+                            f"background-color: white; color: black; text-align: center;"
+                        )
+        return styled
+
+    matched_ions = spectra_df[spectra_df["ion_type"] != ""]
+    accepted_normal_ions = matched_ions[matched_ions["internal"] == False][
+        "ion_label"
+    ].tolist()
+    accepted_internal_ions = matched_ions[matched_ions["internal"] == True][
+        "ion_label"
+    ].tolist()
+    accepted_internal_ions = [ion[:-1] for ion in accepted_internal_ions]
+
+    combined_df["# (abc)"] = list(range(1, len(params.unmodified_sequence) + 1))
+    combined_df["# (xyz)"] = list(range(1, len(params.unmodified_sequence) + 1))[::-1]
+
+    # reorder columns so that # is first # +1 is last and AA is in the middle
+    combined_cols = combined_df.columns.tolist()
+    combined_cols.remove("# (abc)")
+    combined_cols.remove("# (xyz)")
+    combined_cols.remove("AA")
+    forward_cols = [
+        col for col in combined_cols if "a" in col or "b" in col or "c" in col
+    ]
+    reverse_cols = [
+        col for col in combined_cols if "x" in col or "y" in col or "z" in col
+    ]
+
+    # sort
+    forward_cols.sort()
+    reverse_cols.sort(reverse=True)
+
+    new_cols = ["# (abc)"] + forward_cols + ["AA"] + reverse_cols + ["# (xyz)"]
+    combined_df = combined_df[new_cols]
+    len_combined_df = len(combined_df)
+
+    combined_df = combined_df.style.format(precision=4).apply(
+        highlight_cells, axis=None
+    )
+
+    return combined_df
+
+
+# download formats: file extension and mime type
+DOWNLOAD_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Arrow": ("arrow", "application/vnd.apache.arrow.file"),
+}
+
+
+def get_dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """Content hash of a DataFrame (values, index, column names and dtypes)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr([(col, str(dtype)) for col, dtype in df.dtypes.items()]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def serialize_dataframe(df: pd.DataFrame, file_format: str) -> bytes:
+    """Serialize a DataFrame to one of the DOWNLOAD_FORMATS."""
+    if file_format == "CSV":
+        return df.to_csv(index=False).encode("utf-8")
+
+    buffer = io.BytesIO()
+    if file_format == "Parquet":
+        df.to_parquet(buffer, index=False)
+    elif file_format == "Arrow":
+        df.reset_index(drop=True).to_feather(buffer)
+    else:
+        raise ValueError(f"Unsupported download format: {file_format}")
+    return buffer.getvalue()
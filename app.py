@@ -1,13 +1,16 @@
-import tempfile
+import hashlib
 import uuid
+from urllib.parse import parse_qs
 
+import numpy as np
 import pandas as pd
 import streamlit_permalink as stp
 import streamlit as st
 import peptacular as pt
-import matplotlib as mpl
 from streamlit_js_eval import get_page_location
 
+from annotation_util import DOWNLOAD_FORMATS, get_dataframe_fingerprint, get_fragment_match_table, \
+    get_fragment_matches, get_fragments, get_spectra_df, get_spectra_fingerprint, parse_spectra, serialize_dataframe
 from app_input import get_all_inputs
 import constants
 from color_util import get_color_dict
@@ -16,8 +19,9 @@ from plot_util import (
     generate_fragment_plot_ion_type,
     get_fragment_match_table_plotly,
 )
-from util import get_fragment_matches, get_match_cov, get_spectra_df, display_coverage_markdown, \
-    get_fragment_match_table, get_query_params_url, shorten_url
+from permalink_util import STATE_LINK_PARAM, STATE_SPECTRA_PREFIX, get_permalink_store
+from shortlink_util import SHORT_LINK_PARAM, get_short_link_store, get_short_url_cache
+from util import display_coverage_markdown, get_query_params_url
 
 
 @st.cache_data
@@ -28,31 +32,113 @@ def get_cached_fragments(annotation:pt.ProFormaAnnotation,
                   isotopes: list[int],
                   losses: list[(str, float)],
                   immonium_ions: bool):
-    fragmenter = pt.Fragmenter(annotation, is_monoisotopic)
-
-    fragments = pt.fragment(
-        sequence=annotation,
-        ion_types=fragment_types,
-        charges=charges,
-        monoisotopic=is_monoisotopic,
-        isotopes=isotopes,
-        losses=losses,
+    return get_fragments(annotation, is_monoisotopic, fragment_types, charges, isotopes, losses, immonium_ions)
+
+
+@st.cache_data
+def get_cached_fragment_df(annotation: pt.ProFormaAnnotation,
+                           is_monoisotopic: bool,
+                           fragment_types: list[str],
+                           charges: list[int],
+                           isotopes: list[int],
+                           losses: list[(str, float)],
+                           immonium_ions: bool) -> pd.DataFrame:
+    fragments = get_cached_fragments(annotation, is_monoisotopic, fragment_types, charges, isotopes, losses,
+                                     immonium_ions)
+    return pd.DataFrame([fragment.to_dict() for fragment in fragments])
+
+
+@st.cache_data(max_entries=32)
+def get_cached_fragment_match_html(sequence: str, fragment_types: list[str], charges: list[int], min_mz: float,
+                                   max_mz: float, color_dict: dict[str, str], spectra_df: pd.DataFrame,
+                                   frag_df: pd.DataFrame, _params) -> str:
+    """Fragment match table HTML, keyed by every parameter get_fragment_match_table reads from _params."""
+    combined_df = get_fragment_match_table(_params, spectra_df, frag_df)
+
+    df_html = combined_df.to_html()
+
+    for col in combined_df.columns:
+        # if col starts witha number 
+        if col[0].isdigit():
+            ion_type = col[-1]
+            charge = int(col[:-1])
+            df_html = df_html.replace(f"{col}", f"<sup>+{charge}</sup>{ion_type}")
+
+    return df_html
+
+
+@st.cache_data(max_entries=32)
+def get_cached_fragment_plot(unmodified_sequence: str, spectra_df: pd.DataFrame):
+    return generate_fragment_plot_ion_type(unmodified_sequence, spectra_df)
+
+
+@st.cache_data(max_entries=16)
+def get_cached_download(fingerprint: str, file_format: str, _df: pd.DataFrame) -> bytes:
+    return serialize_dataframe(_df, file_format)
+
+
+@st.fragment
+def download_fragment(df: pd.DataFrame, file_stem: str, key: str):
+    """Download controls for a table, the file is only serialized once requested (and cached by content)."""
+    c1, c2 = st.columns([1, 3])
+    file_format = c1.selectbox("Format", list(DOWNLOAD_FORMATS), key=f"{key}_format", label_visibility="collapsed")
+
+    if not c2.button("Prepare Download", key=f"{key}_prepare", use_container_width=True):
+        return
+
+    extension, mime = DOWNLOAD_FORMATS[file_format]
+    st.download_button(
+        label=f"Download {file_format}",
+        data=get_cached_download(get_dataframe_fingerprint(df), file_format, df),
+        file_name=f"{file_stem}.{extension}",
+        mime=mime,
+        use_container_width=True,
+        type="primary",
+        on_click="ignore",
+        key=key,
     )
 
-    if immonium_ions:
-        fragments.extend(
-            fragmenter.fragment(
-                ion_types=["i"],
-                charges=[1],
-                isotopes=isotopes,
-                losses=losses,
-            )
-        )
 
-    return fragments
+@st.fragment
+def svg_download_fragment(fig, width: int, height: int):
+    """Download button for a figure as SVG, the (slow, kaleido backed) export only runs once requested."""
+    if not st.button("Prepare SVG Download", key="svg_prepare", use_container_width=True):
+        return
+
+    st.download_button(
+        label="Download chart as SVG",
+        data=fig.to_image(format="svg", width=width, height=height, scale=1),
+        file_name="spectra.svg",
+        mime="image/svg+xml",
+        use_container_width=True,
+        type="primary",
+        on_click="ignore",
+    )
+
 
 st.set_page_config(page_title="Spectra Viewer", page_icon=":eyeglasses:", layout="wide")
 
+# local short link: replace the code with the query parameters it stands for (before any widget reads them)
+if SHORT_LINK_PARAM in st.query_params:
+    short_link_query = get_short_link_store().resolve(st.query_params[SHORT_LINK_PARAM])
+    if short_link_query is None:
+        st.toast(f"Unknown short link: {st.query_params[SHORT_LINK_PARAM]}")
+        del st.query_params[SHORT_LINK_PARAM]
+    else:
+        st.query_params.from_dict(parse_qs(short_link_query, keep_blank_values=True))
+        st.rerun()
+
+# permalink state: a single lookup, the spectrum is decoded from the stored arrays ('KEY:<key>', see decode_spectra)
+if STATE_LINK_PARAM in st.query_params:
+    state_key = st.query_params[STATE_LINK_PARAM]
+    state_params = get_permalink_store().load_params(state_key)
+    if state_params is None:
+        st.toast(f"Unknown permalink state: {state_key}")
+        del st.query_params[STATE_LINK_PARAM]
+    else:
+        st.query_params.from_dict({**state_params, "spectra": STATE_SPECTRA_PREFIX + state_key})
+        st.rerun()
+
 if 'page_loc' not in st.session_state or st.session_state.page_loc is None:
     page_loc = get_page_location()
     if 'page_loc' not in st.session_state and page_loc is not None:
@@ -159,6 +245,13 @@ if annotation.contains_sequence_ambiguity():
     st.error("Sequence cannot contain ambiguity!")
     st.stop()
 
+# try to parse (and process) the spectra
+try:
+    _ = params.spectra
+except ValueError as err:
+    st.error(f"Error parsing spectra: {err}")
+    st.stop()
+
 
 if 'page_loc' in st.session_state and st.session_state.page_loc and 'origin' in st.session_state.page_loc:
     url_origin = st.session_state.page_loc['origin']
@@ -166,21 +259,43 @@ if 'page_loc' in st.session_state and st.session_state.page_loc and 'origin' in
     @st.fragment
     def url_fragment():
 
-        title_c, _, button_c = st.columns([2, 1, 1])
+        title_c, state_c, button_c = st.columns([2, 1, 1])
         title_c.header("SpecView Results")
 
         if params.stateful:
+            short_url_name = "TinyURL" if constants.SHORT_URL_MODE == "tinyurl" else "Short URL"
             st.caption(
-                '''**This pages URL automatically updates with your input, and can be shared with others. 
-            You can optionally use the Generate TinyURL button to create a shortened URL.**''',
+                f'''**This pages URL automatically updates with your input, and can be shared with others. 
+            You can optionally use the Generate {short_url_name} button to create a shortened URL.**''',
                 unsafe_allow_html=True,
             )
 
-            if button_c.button("Generate TinyURL", key="generate_tinyurl", type="primary"):
+            if button_c.button(f"Generate {short_url_name}", key="generate_tinyurl", type="primary"):
                 url_params = {k: st.query_params.get_all(k) for k in st.query_params.keys()}
                 page_url = f"{url_origin}{get_query_params_url(url_params)}"
-                short_url = shorten_url(page_url)
-                st.write(f"Shortened URL: {short_url}")
+                # shortened on a background thread (cached by URL), a slow shortener only delays this fragment
+                future = get_short_url_cache().submit(page_url)
+                try:
+                    with st.spinner("Shortening URL..."):
+                        short_url = future.result(constants.SHORT_URL_TIMEOUT)
+                    st.write(f"Shortened URL: {short_url}")
+                except TimeoutError:
+                    st.warning("Shortening the URL is taking longer than expected, click the button again to check.")
+                except Exception as e:
+                    st.error(f"Error shortening URL: {e}")
+
+            if state_c.button("Generate State Link", key="generate_state_link"):
+                url_params = {k: st.query_params.get_all(k) for k in st.query_params.keys()}
+                try:
+                    if params.spectra_arrays is not None:
+                        mzs, intensities = params.spectra_arrays
+                    else:
+                        mzs, intensities = parse_spectra(params.spectra_text)
+                except ValueError as e:
+                    st.error(f"Error parsing spectra: {e}")
+                else:
+                    state_key = get_permalink_store().save(url_params, mzs, intensities)
+                    st.write(f"State link: {url_origin}/?{STATE_LINK_PARAM}={state_key}")
         
     url_fragment()
 
@@ -188,17 +303,17 @@ st.divider()
 
 st.session_state.first_run = False
 
-fragments = get_cached_fragments(annotation,
-                        params.is_monoisotopic,
-                        params.fragment_types,
-                        params.charges,
-                        params.isotopes,
-                        params.losses,
-                        params.immonium_ions)
+fragment_args = (annotation,
+                  params.is_monoisotopic,
+                  params.fragment_types,
+                  params.charges,
+                  params.isotopes,
+                  params.losses,
+                  params.immonium_ions)
 
-frag_df = pd.DataFrame([fragment.to_dict() for fragment in fragments])
+fragments = get_cached_fragments(*fragment_args)
 
-if not params.spectra:
+if params.num_peaks == 0:
     st.warning("No spectra....")
     st.stop()
 
@@ -212,14 +327,13 @@ if not fragment_matches:
 spectra_df = get_spectra_df(params, fragment_matches)
 
 match_df = spectra_df[spectra_df["matched"]]
-cmap = mpl.colormaps.get_cmap("Blues")
 
 # Show Sequence Info
 st.subheader(params.sequence)
 c1, c2, c3, c4 = st.columns(4)
 
 c1.metric("Mass", round(pt.mass(annotation), 4))
-c2.metric("Peaks", len(params.spectra))
+c2.metric("Peaks", params.num_peaks)
 c3.metric("Fragments", len(fragments))
 total_intensity = spectra_df["intensity"].sum()
 #c1.metric(label="Total Intensity", value=round(total_intensity, 1))
@@ -230,72 +344,150 @@ c4.metric(
     value=round(match_df["intensity"].sum() / total_intensity * 100, 2),
 )
 
-spectra_tab, coverage_tab, data_tab = st.tabs(["Spectra", "Coverage", "Data"])
-
-with spectra_tab:
-
-    with st.expander('Custom Annotations'):
+# custom annotations are rendered outside of the views so the editor keeps its state when switching views.
+# The editor only shows a page of relevant peaks; edits are kept as a sparse {peak index: (label, color)} dict
+# that is overlaid onto spectra_df, and are reset whenever the peaks change.
+annotation_scope = get_spectra_fingerprint(spectra_df["mz"].to_numpy(), spectra_df["intensity"].to_numpy())
+if st.session_state.get("custom_annotations_scope") != annotation_scope:
+    st.session_state["custom_annotations_scope"] = annotation_scope
+    st.session_state["custom_annotations_edits"] = {}
+    st.session_state["custom_annotations_generation"] = 0
+annotation_edits = st.session_state["custom_annotations_edits"]
+
+with st.expander('Custom Annotations'):
+
+    c1, c2, c3 = st.columns(3)
+    annotation_top_n = c1.number_input("Top N Peaks",
+                                       min_value=0,
+                                       value=constants.DEFAULT_ANNOTATION_TOP_N,
+                                       help=constants.ANNOTATION_TOP_N_HELP,
+                                       key="custom_annotations_top_n")
+    annotation_search_mz = c2.number_input("Search m/z",
+                                           min_value=0.0,
+                                           value=0.0,
+                                           help=constants.ANNOTATION_SEARCH_MZ_HELP,
+                                           key="custom_annotations_search_mz")
+    annotation_search_tolerance = c3.number_input("Search Tolerance (Th)",
+                                                  min_value=0.0,
+                                                  value=constants.DEFAULT_ANNOTATION_SEARCH_TOLERANCE,
+                                                  help=constants.ANNOTATION_SEARCH_TOLERANCE_HELP,
+                                                  key="custom_annotations_search_tolerance")
+
+    if annotation_search_mz > 0:
+        annotation_rows = np.flatnonzero(
+            np.abs(spectra_df["mz"].to_numpy() - annotation_search_mz) <= annotation_search_tolerance)
+    else:
+        # matched peaks, the top N most intense peaks and already edited peaks
+        intensities = spectra_df["intensity"].to_numpy()
+        top_n = min(annotation_top_n, len(intensities))
+        top_rows = np.argpartition(intensities, len(intensities) - top_n)[len(intensities) - top_n:] if top_n else []
+        annotation_rows = np.union1d(np.flatnonzero(spectra_df["matched"].to_numpy()), top_rows)
+        annotation_rows = np.union1d(annotation_rows, list(annotation_edits)).astype(int)
+
+    page_count = max(1, -(-len(annotation_rows) // constants.ANNOTATION_PAGE_SIZE))
+    annotation_page = st.number_input(f"Page (of {page_count})",
+                                      min_value=1,
+                                      max_value=page_count,
+                                      value=1,
+                                      help=constants.ANNOTATION_PAGE_HELP,
+                                      key="custom_annotations_page")
+    page_start = (min(annotation_page, page_count) - 1) * constants.ANNOTATION_PAGE_SIZE
+    annotation_rows = annotation_rows[page_start:page_start + constants.ANNOTATION_PAGE_SIZE]
+
+    with st.form(key="custom_annotations_form"):
+        st.markdown(
+            "Select the peaks to annotate. You can also add custom labels to the peaks."
+        )
+        st.caption(
+            f"Showing {len(annotation_rows)} of {len(spectra_df)} peaks. Edits are kept when changing the page or search."
+        )
 
-        # show mz, intensity, and then make a bool column to let users which peaks to show annotations for
-        
-        with st.form(key="custom_annotations_form"):
-            st.markdown(
-                "Select the peaks to annotate. You can also add custom labels to the peaks."
-            )
-            st.caption(
-                "Note: The table will be updated with the selected peaks and their labels."
-            )
+        editor_df = spectra_df.iloc[annotation_rows][["mz", "intensity", "label"]].copy()
+        editor_df.insert(0, "peak_index", annotation_rows)
+        # set None peaks to unassigned
+        editor_df['peak'] = editor_df['label'].astype(object).fillna('unassigned')
+        editor_df["custom_label"] = [annotation_edits.get(i, (None, None))[0] for i in annotation_rows]
+        editor_df["custom_color"] = [annotation_edits.get(i, (None, None))[1] for i in annotation_rows]
+
+        # the editor state belongs to the rows it was created for
+        editor_key = (f"custom_annotations_{st.session_state['custom_annotations_generation']}_"
+                      f"{hashlib.blake2b(annotation_rows.tobytes(), digest_size=8).hexdigest()}")
+        editor_df = st.data_editor(editor_df, hide_index=True,
+                                            use_container_width=True,
+                                            column_order=["mz", "intensity", "peak", "custom_label", "custom_color"],
+                                            column_config={
+                                                "mz": st.column_config.NumberColumn(
+                                                    "M/Z",
+                                                    format="%.4f",
+                                                    help="M/Z of the peak",
+                                                    disabled=True,
+                                                    width="small",
+                                                ),
+                                                "intensity": st.column_config.NumberColumn(
+                                                    "Intensity",
+                                                    format="%.1f",
+                                                    help="Intensity of the peak",
+                                                    disabled=True,
+                                                    width="small",
+                                                ),
+                                                "peak": st.column_config.TextColumn(
+                                                    "Peak",
+                                                    help="Peak",
+                                                    disabled=True,
+                                                    width="small",
+                                                ),
+                                                "custom_label": st.column_config.TextColumn(
+                                                    "Custom Label",
+                                                    help="Label of the peak",
+                                                    width="large",
+                                                ),
+                                                "custom_color": st.column_config.TextColumn(
+                                                    "Custom Color",
+                                                    help="Color of the peak",
+                                                    width="large",
+                                                ),
+                                            },
+                                            key=editor_key
+                                            )
+
+        form_submit = st.form_submit_button("Submit", type="primary", use_container_width=True)
+
+    for peak_index, label, color in zip(editor_df["peak_index"], editor_df["custom_label"], editor_df["custom_color"]):
+        label = label if isinstance(label, str) and label != "" else None
+        color = color if isinstance(color, str) and color != "" else None
+        if label is None and color is None:
+            annotation_edits.pop(int(peak_index), None)
+        else:
+            annotation_edits[int(peak_index)] = (label, color)
+
+    if annotation_edits and st.button("Clear Custom Annotations", use_container_width=True):
+        annotation_edits.clear()
+        # a new editor key drops the editor's own record of the cleared edits
+        st.session_state["custom_annotations_generation"] += 1
+        st.rerun()
+
+spectra_df["custom_label"] = None
+spectra_df["custom_color"] = None
+if annotation_edits:
+    edited_rows = list(annotation_edits)
+    spectra_df.loc[edited_rows, "custom_label"] = [label for label, _ in annotation_edits.values()]
+    spectra_df.loc[edited_rows, "custom_color"] = [color for _, color in annotation_edits.values()]
+
+    # Update the color column only for rows with custom_color values
+    mask = spectra_df['custom_color'].notna()
+    if mask.any():
+        spectra_df['color'] = spectra_df['custom_color'].where(mask, spectra_df['color'].astype(object))
+
+results_view = st.segmented_control(
+    "View",
+    options=["Spectra", "Coverage", "Data"],
+    default="Spectra",
+    key="results_view",
+    label_visibility="collapsed",
+)
 
-            spectra_df["custom_label"] = None
-            spectra_df['peak'] = spectra_df['label']
-
-            #set None peaks to unassigned
-            spectra_df.loc[spectra_df['peak'].isna(), 'peak'] = 'unassigned'
-            spectra_df["custom_color"] = None
-
-            spectra_df = st.data_editor(spectra_df, hide_index=True,
-                                                use_container_width=True,
-                                                column_order=["mz", "intensity", "peak", "custom_label", "custom_color"],
-                                                column_config={
-                                                    "mz": st.column_config.NumberColumn(
-                                                        "M/Z",
-                                                        format="%.4f",
-                                                        help="M/Z of the peak",
-                                                        disabled=True,
-                                                        width="small",
-                                                    ),
-                                                    "intensity": st.column_config.NumberColumn(
-                                                        "Intensity",
-                                                        format="%.1f",
-                                                        help="Intensity of the peak",
-                                                        disabled=True,                                                    
-                                                        width="small",
-                                                    ),
-                                                    "label": st.column_config.TextColumn(
-                                                        "Peak",
-                                                        help="Peak",
-                                                        disabled=True,
-                                                        width="small",
-                                                    ),
-                                                    "custom_label": st.column_config.TextColumn(
-                                                        "Custom Label",
-                                                        help="Label of the peak",
-                                                        width="large",
-                                                    ),
-                                                    "custom_color": st.column_config.TextColumn(
-                                                        "Custom Color",
-                                                        help="Color of the peak",
-                                                        width="large",
-                                                    ),
-                                                },
-                                                key="custom_annotations"
-                                                )
-
-            form_submit = st.form_submit_button("Submit", type="primary", use_container_width=True)
-            
-    # Update the color column only for rows with non-null and non-empty custom_color values
-    mask = (spectra_df['custom_color'].notna()) & (spectra_df['custom_color'] != "")
-    spectra_df.loc[mask, 'color'] = spectra_df.loc[mask, 'custom_color']
+# only the selected view is computed
+if results_view in (None, "Spectra"):
 
     with st.expander("Zoom Options"):
         with st.form('Zoom Options'):
@@ -355,81 +547,40 @@ with spectra_tab:
     #frag_table_plotly = get_fragment_match_table_plotly(params, spectra_df, frag_df)
     st.divider()
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".svg") as tmpfile:
-        # Save the figure to the temporary file
-        spectra_fig.write_image(
-            file=tmpfile.name, format="svg", width=params.fig_width, height=params.fig_height, scale=1
-        )
-
-        # Read the content of the temporary file
-        tmpfile.seek(0)  # Go to the start of the file
-        data = tmpfile.read()
-
-    # Create a download button in Streamlit
-    st.download_button(
-        label="Download chart as SVG",
-        data=data,
-        file_name="spectra.svg",
-        mime="image/svg+xml",
-        use_container_width=True,
-        on_click="ignore",
-    )
+    svg_download_fragment(spectra_fig, params.fig_width, params.fig_height)
 
-with coverage_tab:
+elif results_view == "Coverage":
 
     st.subheader("Sequence Coverage", divider=True)
     display_coverage_markdown(params, spectra_df)
 
     st.subheader("Fragment Matches", divider=True)
-    combined_df = get_fragment_match_table(params, spectra_df, frag_df)
-
-    df_html = combined_df.to_html()
-
-    for col in combined_df.columns:
-        # if col starts witha number 
-        if col[0].isdigit():
-            ion_type = col[-1]
-            charge = int(col[:-1])
-            df_html = df_html.replace(f"{col}", f"<sup>+{charge}</sup>{ion_type}")
-            
-    st.html(df_html)
+    frag_df = get_cached_fragment_df(*fragment_args)
+    st.html(get_cached_fragment_match_html(params.sequence, params.fragment_types, params.charges, params.min_mz,
+                                           params.max_mz, params.color_dict, spectra_df, frag_df, params))
 
     st.subheader("Fragment Locations", divider=True)
     st.plotly_chart(
-        generate_fragment_plot_ion_type(params.unmodified_sequence, spectra_df),
+        get_cached_fragment_plot(params.unmodified_sequence, spectra_df),
         use_container_width=True,
     )
 
     #error_fig = generate_error_histogram(spectra_df, params.mass_tolerance_type)
     #st.plotly_chart(error_fig, use_container_width=True)
 
-with data_tab:
+elif results_view == "Data":
+
+    frag_df = get_cached_fragment_df(*fragment_args)
 
     st.subheader("Fragment Data", divider=True)
     st.dataframe(frag_df, hide_index=True)
 
-    st.download_button(
-        label="Download Data",
-        data=frag_df.to_csv(index=False).encode("utf-8"),
-        file_name=f"{annotation.serialize()}_fragment_data.csv",
-        use_container_width=True,
-        type="secondary",
-        on_click="ignore",
-        key="download_frag_data",
-    )
+    download_fragment(frag_df, f"{annotation.serialize()}_fragment_data", key="download_frag_data")
 
     st.subheader("Spectra Data", divider=True)
     st.dataframe(spectra_df, hide_index=True)
 
-    st.download_button(
-        label="Download Data",
-        data=spectra_df.to_csv(index=False).encode("utf-8"),
-        file_name=f"{annotation.serialize()}_spectra_data.csv",
-        use_container_width=True,
-        type="secondary",
-        on_click="ignore",
-        key="download_spectra_data",
-    )
+    download_fragment(spectra_df, f"{annotation.serialize()}_spectra_data", key="download_spectra_data")
 
 
 st.divider()
@@ -1,239 +1,48 @@
+import hashlib
+import os
 from functools import cached_property
 
 import streamlit as st
 import streamlit_permalink as stp
-import peptacular as pt
-from dataclasses import dataclass
-from typing import List, Tuple
+import numpy as np
+from typing import Optional, Tuple
 
+import annotation_util
 import constants
+from annotation_util import RAW_SPECTRA_PREFIX, decode_raw_spectra, encode_raw_spectra, get_spectra_fingerprint, \
+    parse_sequence, serialize_sequence
 from color_util import get_color_dict
-from msms_compression import SpectrumCompressorUrl
-from msdecon.deconvolution import deconvolute
-
-@dataclass
-class SpectraInputs:
-    """Dataclass to store all spectra viewer inputs."""
-    # Sequence parameters
-    sequence: str
-    
-    # Mass tolerance parameters
-    mass_tolerance_type: str
-    mass_tolerance: float
-    
-    # Charge parameters
-    min_charge: int
-    max_charge: int
-    
-    # Spectra data
-    spectra_text: str
-    
-    # Fragment parameters
-    fragment_types: List[str]
-    immonium_ions: bool
-    mass_type: str
-    peak_assignment: str
-    
-    # Isotope parameters
-    num_isotopes: int
-    filter_missing_mono: bool
-    filter_interrupted_iso: bool
-    
-    # Plot parameters
-    y_axis_scale: str
-    hide_unassigned_peaks: bool
-    min_mz: float
-    max_mz: float
-    min_intensity_type: str
-    min_intensity: float
-    max_intensity_type: str
-    max_intensity: float
-    line_width: float
-    text_size: float
-    marker_size: float
-    axis_text_size: float
-    title_text_size: float
-    tick_text_size: float
-    fig_width: float
-    fig_height: float
-    hide_error_percentile_labels: bool
-    bold_labels: bool
-    color_dict: dict[str, str]
-    
-    # Neutral loss parameters
-    h2o_loss: bool
-    nh3_loss: bool
-    h3po4_loss: bool
-    custom_loss_str: str
-
-    #deconvolution parameters
-    deconvolute: bool
-    deconvolute_error_type: str
-    deconvolute_error: float
-
-    stateful: bool = True
-    @property
-    def custom_losses(self) -> dict[str, float]:
-
-        if self.custom_loss_str:
-            return {
-                nl.split(":")[0]: float(nl.split(":")[1])
-                for nl in self.custom_loss_str.split(";")
-            }
-        else:
-            return {}
-    
-    @property
-    def neutral_losses(self) -> dict[str, float]:
-        losses = {}
-        if self.h2o_loss:
-            losses['[STED]'] = -18.01056
-        if self.nh3_loss:
-            losses['[RKNQ]'] = -17.02655
-        if self.h3po4_loss:
-            losses['[ST]'] = -97.9769
-
-        losses.update(self.custom_losses)
-
-        return losses
-    
-    @property
-    def losses(self) -> list[tuple[str, float]]:
-        return list(self.neutral_losses.items()) + list(self.custom_losses.items())
-    
-    @property
-    def ion_types(self) -> list[str]:
-        return [
-            f"{f}{c}"
-            for f in self.fragment_types
-            for c in range(self.min_charge, self.max_charge + 1)
-        ]
-
-    @cached_property
-    def spectra(self) -> list[tuple[float, float]]:
-
-        spectra = parse_sequence(self.spectra_text)
-
-        # filter
-        if self.min_intensity_type == "relative":
-            max_intensity = max([intensity for _, intensity in spectra])
-            spectra = [
-                (mz, intensity)
-                for mz, intensity in spectra
-                if intensity >= self.min_intensity / 100 * max_intensity
-            ]
-
-        if self.min_intensity_type == "absolute":
-            spectra = [
-                (mz, intensity)
-                for mz, intensity in spectra
-                if intensity >= self.min_intensity
-            ]
-
-        if self.max_intensity_type == "relative":
-            max_intensity = max([intensity for _, intensity in spectra])
-            spectra = [
-                (mz, intensity)
-                for mz, intensity in spectra
-                if intensity <= self.max_intensity / 100 * max_intensity
-            ]
-
-        if self.max_intensity_type == "absolute":
-            spectra = [
-                (mz, intensity)
-                for mz, intensity in spectra
-                if intensity <= self.max_intensity
-            ]
-
-        if self.min_mz:
-            spectra = [
-                (mz, intensity)
-                for mz, intensity in spectra
-                if mz >= self.min_mz
-            ]
-
-        if self.max_mz:
-            spectra = [
-                (mz, intensity)
-                for mz, intensity in spectra
-                if mz <= self.max_mz
-            ]
-
-        if self.deconvolute:
-            peaks = deconvolute(spectra,
-                                  tolerance=self.deconvolute_error,
-                                  tolerance_type=self.deconvolute_error_type,
-                                  charge_range=(self.min_charge, self.max_charge))
-
-            spectra = [(p.base_peak.mz, p.total_intensity) for p in peaks]
-
-        return spectra
+from compression_util import LOSSY_URL_CODECS, get_compression_api, get_payload_codec, get_url_codec
+from file_util import SPECTRA_FILE_FORMATS, SpectrumStore, format_scan_info, get_file_format, get_spectrum_store, \
+    prune_spectrum_stores
+from permalink_util import STATE_SPECTRA_PREFIX, get_permalink_store
+from spectra_util import deconvolute_spectra
 
-    @cached_property
-    def min_spectra_mz(self):
-        return min([mz for mz, _ in self.spectra])
 
-    @cached_property
-    def max_spectra_mz(self):
-        return max([mz for mz, _ in self.spectra])
-    
-    @cached_property
-    def min_spectra_intensity(self):
-        return min([intensity for _, intensity in self.spectra])
-    
-    @cached_property
-    def max_spectra_intensity(self):
-        return max([intensity for _, intensity in self.spectra])
-    
-    @cached_property
-    def mz_values(self) -> list[float]:
-        return [mz for mz, _ in self.spectra]
-    
-    @cached_property
-    def intensity_values(self) -> list[float]:
-        return [intensity for _, intensity in self.spectra]
+class SpectraInputs(annotation_util.SpectraInputs):
+    """SpectraInputs of the app: processed spectra and deconvolutions are cached across reruns and sessions."""
 
     @cached_property
-    def mz_int_values(self) -> (list[float], list[float]):
-        return self.mz_values, self.intensity_values
-    
-    
-    def get_color(self, ion: str, charge: int) -> str:
-        """Get color for a specific ion and charge."""
-
-        if ion is None or charge is None:
-            return self.color_dict['unassigned']
-
-        color_key = f'{"+" * charge}{ion}'
-        if color_key in self.color_dict:
-            return self.color_dict[color_key]
-        else:
-            return self.color_dict['unassigned']
-
-    
-    @property
-    def charges(self) -> list[int]:
-        return [
-            c
-            for c in range(self.min_charge, self.max_charge + 1)
-        ]
-    
-
-    @property
-    def unmodified_sequence(self) -> str:
-        return pt.strip_mods(self.sequence)
-
-    @property
-    def is_monoisotopic(self) -> bool:
-        return self.mass_type == "monoisotopic"
-
-    @property
-    def isotopes(self) -> list[int]:
-        return list(range(self.num_isotopes + 1))
-
-    @property
-    def peak_assignment_type(self) -> str:
-        return "largest" if self.peak_assignment == "most intense" else "closest"
+    def spectra(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Filtered (and optionally deconvoluted) m/z and intensity arrays."""
+        try:
+            return get_cached_processed_spectra(self.spectra_key, self)
+        except TimeoutError as e:
+            st.warning(f"{e}, showing the spectrum without deconvolution.")
+            return self.process_spectra(deconvolute=False)
+
+    def deconvolute_spectra(self, mzs: np.ndarray, intensities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        deconvoluted = get_cached_deconvolution(
+            get_spectra_fingerprint(mzs, intensities),
+            self.deconvolute_error,
+            self.deconvolute_error_type,
+            (self.min_charge, self.max_charge),
+            mzs,
+            intensities,
+        )
+        if deconvoluted is None:
+            raise TimeoutError(f"Deconvolution did not finish within {constants.DECONVOLUTION_TIMEOUT} seconds")
+        return deconvoluted
 
 
 def get_ion_label(i: str, c: int) -> str:
@@ -241,67 +50,128 @@ def get_ion_label(i: str, c: int) -> str:
     return "+" * c + i
 
 
-def parse_sequence(input_str: str) -> List[Tuple[float, float]]:
-    """Parse sequence string into list of mz and intensity tuples."""
-
-    if not input_str:
-        return []
+@st.cache_data(max_entries=constants.DECONVOLUTION_CACHE_SIZE, show_spinner="Deconvoluting...")
+def get_cached_deconvolution(fingerprint: str, tolerance: float, tolerance_type: str, charge_range: Tuple[int, int],
+                             _mzs: np.ndarray, _intensities: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Deconvolute (shared across sessions and reruns), keyed by the spectrum's fingerprint and the settings.
+    Returns None if the deconvolution timed out, which is cached too so reruns don't wait for the timeout again.
+    """
+    try:
+        return deconvolute_spectra(_mzs, _intensities, tolerance, tolerance_type, charge_range,
+                                   timeout=constants.DECONVOLUTION_TIMEOUT, processes=constants.DECONVOLUTION_WORKERS)
+    except TimeoutError:
+        return None
 
-    mz_values, intensity_values = [], []
-    lines = input_str.split("\n")
-    for line in lines:
-        parts = line.split(" ")
-        if len(parts) == 2:
-            try:
-                mz_values.append(float(parts[0]))
-                intensity_values.append(float(parts[1]))
-            except ValueError:
-                raise ValueError(f"Invalid input line: {parts}")
-        else:
-            raise ValueError(f"Invalid input format: {input_str}")
-    return list(zip(mz_values, intensity_values))
 
+@st.cache_data(max_entries=constants.SPECTRA_CACHE_SIZE)
+def get_cached_processed_spectra(spectra_key: str, _params: SpectraInputs) -> Tuple[np.ndarray, np.ndarray]:
+    """Processed spectrum shared across reruns and sessions, keyed by SpectraInputs.spectra_key."""
+    return _params.process_spectra()
 
-def serialize_sequence(sequence: List[Tuple[float, float]]) -> str:
-    """Convert list of mz and intensity tuples to string format."""
-    return "\n".join(f"{round(s[0], 5)} {round(s[1], 2)}" for s in sequence)
 
 @st.cache_data
 def compress_spectra(input_str: str) -> str:
-    """Compress spectra string for URL encoding."""
+    """Compress spectra string for URL encoding (through the compression API and its shared store)."""
     try:
-        spectra = parse_sequence(input_str)
-        mzs, ints = [], []
-        if spectra:
-            mzs, ints = zip(*spectra)
-        value = SpectrumCompressorUrl.compress(mzs, ints)
-        return value
+        return get_compression_api().compress(input_str)
     except ValueError as e:
         st.error(f"Error compressing spectra: {e}")
-        return SpectrumCompressorUrl.compress([], [])
+        return get_url_codec().compress([], [])
 
 
 @st.cache_data
-def decompress_spectra(input_str: str) -> str:
-    """Decompress spectra string from URL encoding."""
-    if input_str.startswith("RAW:"):
-        mzs, ints = zip(
-            *[
-                (float(elem.split(":")[0]), float(elem.split(":")[1]))
-                for elem in input_str[4:].split(";")
-            ]
-        )
-        return serialize_sequence(list(zip(mzs, ints)))
-
+def decode_spectra(input_str: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode spectra arrays from URL encoding (through the compression API and its shared store)."""
     try:
-        mzs, ints = SpectrumCompressorUrl.decompress(input_str)
-        spectra = list(zip(mzs, ints))
-        return serialize_sequence(spectra)
+        if input_str.startswith(RAW_SPECTRA_PREFIX):
+            return decode_raw_spectra(input_str)
+        if input_str.startswith(STATE_SPECTRA_PREFIX):
+            spectra = get_permalink_store().load_spectra(input_str[len(STATE_SPECTRA_PREFIX):])
+            if spectra is None:
+                raise ValueError("Unknown permalink state")
+            return spectra
+        return get_compression_api().decompress(input_str)
     except ValueError as e:
         st.error(f"Error decompressing spectra: {e}")
         raise ValueError(f"Error decompressing spectra: {e}") from e
 
 
+@st.cache_data
+def decompress_spectra(input_str: str) -> str:
+    """Decompress spectra string from URL encoding (the text shown in the spectra text area)."""
+    mzs, ints = decode_spectra(input_str)
+    return serialize_sequence(list(zip(mzs.tolist(), ints.tolist())))
+
+
+def get_url_spectra(spectra_text: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Get the permalink's spectra as decoded arrays, skipping the rounded text round-trip.
+
+    Returns None if there is no spectra in the URL or the text area no longer shows it (edited by the user).
+    """
+    url_value = st.query_params.get("spectra")
+    if not url_value:
+        return None
+
+    try:
+        if decompress_spectra(url_value) != spectra_text:
+            return None
+        return decode_spectra(url_value)
+    except ValueError:
+        return None
+
+
+@st.cache_resource(max_entries=8, show_spinner="Converting spectra file...")
+def get_cached_spectrum_store(file_id: str, _spectra_file) -> SpectrumStore:
+    """
+    Convert an uploaded spectra file into a memory-mapped spectrum store (once per file content), so switching
+    scans only slices arrays. Cached as a resource since st.cache_data would copy the mapped arrays on every hit.
+    The store directory is kept under SPECTRUM_STORE_MAX_SIZE by deleting the least recently used stores.
+    """
+    digest = hashlib.blake2b(_spectra_file.getbuffer(), digest_size=16).hexdigest()
+    store_dir = os.path.join(constants.SPECTRUM_STORE_DIR, digest)
+    os.makedirs(constants.SPECTRUM_STORE_DIR, exist_ok=True)
+    store = get_spectrum_store(_spectra_file, get_file_format(_spectra_file.name), store_dir)
+    prune_spectrum_stores(constants.SPECTRUM_STORE_DIR, constants.SPECTRUM_STORE_MAX_SIZE, keep=store_dir)
+    return store
+
+
+def get_file_spectra(spectra_file) -> Tuple[Optional[Tuple[np.ndarray, np.ndarray]], str]:
+    """Select a scan from an uploaded spectra file, returns the scan's arrays and a label identifying it."""
+
+    try:
+        store = get_cached_spectrum_store(spectra_file.file_id, spectra_file)
+    except ValueError as e:
+        st.error(f"Error reading spectra file: {e}")
+        return None, ""
+
+    scan_index = store.scan_index
+
+    if len(scan_index) == 0:
+        st.warning(f"No spectra found in {spectra_file.name}")
+        return None, ""
+
+    scan = st.number_input(
+        label="Scan Number",
+        value=scan_index[0].scan,
+        min_value=scan_index.min_scan,
+        max_value=scan_index.max_scan,
+        step=1,
+        help=constants.SPECTRA_FILE_SCAN_HELP,
+        key="spectra_file_scan",
+    )
+
+    scan_info = scan_index.find(scan)
+    if scan_info is None:
+        st.warning(f"Scan {scan} not found in {spectra_file.name}")
+        return None, ""
+
+    st.caption(f"{format_scan_info(scan_info)} ({len(scan_index)} scans in file)")
+
+    return store.get(scan), f"{spectra_file.name}:{scan_info.scan}"
+
+
 def get_all_inputs(stateful: bool) -> SpectraInputs:
     """Get all inputs from the Streamlit UI and return as a SpectraInputs dataclass."""
 
@@ -342,6 +212,25 @@ def get_all_inputs(stateful: bool) -> SpectraInputs:
             stateful=stateful,
         )
 
+        # uploaded files are not part of the permalink
+        spectra_file = st.file_uploader(
+            label="Spectra File",
+            type=SPECTRA_FILE_FORMATS,
+            help=constants.SPECTRA_FILE_HELP,
+            key="spectra_file",
+        )
+
+        spectra_arrays, spectra_source = None, ""
+        if spectra_file is not None:
+            spectra_arrays, spectra_source = get_file_spectra(spectra_file)
+        elif stateful:
+            spectra_arrays = get_url_spectra(spectra_text)
+            lossy_codec = get_payload_codec(st.query_params.get("spectra", ""))
+            if lossy_codec in LOSSY_URL_CODECS:
+                st.warning(f"The spectrum is too large for the page URL at full precision, the URL stores it with "
+                           f"lossy compression ({LOSSY_URL_CODECS[lossy_codec]}). Use Generate State Link to share "
+                           f"it exactly.")
+
     with frag_tab:
 
         # Fragment ion selection
@@ -482,6 +371,70 @@ def get_all_inputs(stateful: bool) -> SpectraInputs:
                 stateful=stateful,
             )
 
+        peak_picker = stp.checkbox(
+            label="Peak Picker",
+            value=constants.DEFAULT_PEAK_PICKER,
+            help=constants.PEAK_PICKER_HELP,
+            key="peak_picker",
+            stateful=stateful,
+        )
+
+        c1, c2 = st.columns(2)
+        with c1:
+            peak_picker_min_intensity = stp.number_input(
+                label="Peak Picker Min Intensity",
+                value=constants.DEFAULT_PEAK_PICKER_MIN_INTENSITY,
+                min_value=0.0,
+                help=constants.PEAK_PICKER_MIN_INTENSITY_HELP,
+                key="peak_picker_min_intensity",
+                disabled=not peak_picker,
+                stateful=stateful,
+            )
+
+        with c2:
+            peak_picker_mass_tolerance = stp.number_input(
+                label="Peak Picker Tolerance (Th)",
+                value=constants.DEFAULT_PEAK_PICKER_MASS_TOLERANCE,
+                min_value=0.0,
+                step=0.01,
+                help=constants.PEAK_PICKER_MASS_TOLERANCE_HELP,
+                key="peak_picker_mass_tolerance",
+                disabled=not peak_picker,
+                stateful=stateful,
+            )
+
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            top_n_peaks = stp.number_input(
+                label="Top N Peaks",
+                value=constants.DEFAULT_TOP_N_PEAKS,
+                min_value=0,
+                help=constants.TOP_N_HELP,
+                key="top_n_peaks",
+                stateful=stateful,
+            )
+
+        with c2:
+            bottom_n_peaks = stp.number_input(
+                label="Bottom N Peaks",
+                value=constants.DEFAULT_BOTTOM_N_PEAKS,
+                min_value=0,
+                help=constants.BOTTOM_N_HELP,
+                key="bottom_n_peaks",
+                stateful=stateful,
+            )
+
+        with c3:
+            peak_window = stp.number_input(
+                label="Peak Window (Th)",
+                value=constants.DEFAULT_PEAK_WINDOW,
+                min_value=0.0,
+                step=10.0,
+                help=constants.PEAK_WINDOW_HELP,
+                key="peak_window",
+                stateful=stateful,
+            )
+
         c1, c2 = st.columns(2)
         with c1:
             min_mz = stp.number_input(
@@ -744,6 +697,12 @@ def get_all_inputs(stateful: bool) -> SpectraInputs:
         deconvolute=deconvolute,
         deconvolute_error_type=deconvolute_error_type,
         deconvolute_error=deconvolute_error,
+        peak_picker=peak_picker,
+        peak_picker_min_intensity=peak_picker_min_intensity,
+        peak_picker_mass_tolerance=peak_picker_mass_tolerance,
+        top_n_peaks=top_n_peaks,
+        bottom_n_peaks=bottom_n_peaks,
+        peak_window=peak_window,
         stateful=stateful,
         text_size=text_size,
         line_width=line_width,
@@ -755,6 +714,8 @@ def get_all_inputs(stateful: bool) -> SpectraInputs:
         fig_height=fig_height,
         hide_error_percentile_labels=hide_error_percentile_labels,
         bold_labels=bold_labels,
-        color_dict=color_dict
+        color_dict=color_dict,
+        spectra_source=spectra_source,
+        spectra_arrays=spectra_arrays,
     )
 
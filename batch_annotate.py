@@ -0,0 +1,329 @@
+"""
+Headless batch annotation of PSMs with the viewer's fragment -> match -> spectra_df pipeline.
+
+The input table (CSV, TSV or Parquet) has one row per PSM with a 'sequence' column and either a 'spectra'
+column ('m/z intensity' lines, as in the app's text area), 'mzs' and 'intensities' columns (lists) or 'file' and
+'scan' columns (MGF, MS2 or mzML).
+Any other column named after a SpectraInputs field (e.g. mass_tolerance, max_charge, fragment_types)
+overrides the defaults for that row; --param key=value overrides them for every row.
+
+    python batch_annotate.py psms.csv -o metrics.parquet --svg-dir svgs --processes 4
+"""
+
+import argparse
+import ast
+import dataclasses
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import peptacular as pt
+
+import constants
+from annotation_util import SpectraInputs, get_fragment_matches, get_fragments, get_spectra_df, serialize_sequence
+from color_util import get_color_dict
+from file_util import read_scan_from_path
+from plot_util import generate_annonated_spectra_plotly
+
+
+# the defaults of the app's widgets
+DEFAULT_INPUTS = dict(
+    sequence=constants.DEFAULT_SEQUENCE,
+    mass_tolerance_type=constants.DEFAULT_MASS_TOLERANCE_TYPE,
+    mass_tolerance=constants.DEFAULT_PPM_MASS_TOLERANCE,
+    min_charge=1,
+    max_charge=2,
+    spectra_text=serialize_sequence(constants.DEFAULT_SPECTRA),
+    fragment_types=[f for f in constants.DEFAULT_FRAGMENT_TYPES if f != 'immonium'],
+    # the app's immonium toggle is the 'immonium' fragment type pill
+    immonium_ions='immonium' in constants.DEFAULT_FRAGMENT_TYPES,
+    mass_type=constants.DEFAULT_MASS_TYPE,
+    peak_assignment=constants.DEFAULT_PEAK_ASSIGNMENT,
+    num_isotopes=0,
+    filter_missing_mono=False,
+    filter_interrupted_iso=False,
+    y_axis_scale=constants.DEFAULT_YAXIS_SCALE,
+    hide_unassigned_peaks=False,
+    min_mz=0.0,
+    max_mz=1_000_000.0,
+    min_intensity_type=constants.DEFAULT_MIN_INTENSITY_TYPE,
+    min_intensity=0.0,
+    max_intensity_type='absolute',
+    max_intensity=1e9,
+    line_width=2.0,
+    text_size=20.0,
+    marker_size=6.0,
+    axis_text_size=15.0,
+    title_text_size=20.0,
+    tick_text_size=15.0,
+    fig_width=800,
+    fig_height=600,
+    hide_error_percentile_labels=False,
+    bold_labels=False,
+    color_dict=None,
+    h2o_loss=False,
+    nh3_loss=False,
+    h3po4_loss=False,
+    custom_loss_str='',
+    deconvolute=False,
+    deconvolute_error_type='ppm',
+    deconvolute_error=10.0,
+    peak_picker=constants.DEFAULT_PEAK_PICKER,
+    peak_picker_min_intensity=constants.DEFAULT_PEAK_PICKER_MIN_INTENSITY,
+    peak_picker_mass_tolerance=constants.DEFAULT_PEAK_PICKER_MASS_TOLERANCE,
+    top_n_peaks=constants.DEFAULT_TOP_N_PEAKS,
+    bottom_n_peaks=constants.DEFAULT_BOTTOM_N_PEAKS,
+    peak_window=constants.DEFAULT_PEAK_WINDOW,
+    stateful=False,
+)
+
+INPUT_FIELDS = {f.name for f in dataclasses.fields(SpectraInputs)}
+
+
+def parse_param_value(value: Any, default: Any) -> Any:
+    """
+    Convert a table cell or --param string to the type of the parameter's default, missing values (NaN) give the
+    default.
+    """
+    if not isinstance(value, str):
+        value = value.item() if isinstance(value, np.generic) else value
+        if _is_missing(value):
+            return default
+        # pandas reads an int (or bool) column with blank cells as float
+        if isinstance(default, bool) and isinstance(value, (bool, int, float)):
+            return bool(value)
+        if isinstance(default, int) and isinstance(value, (int, float)):
+            if not float(value).is_integer():
+                raise ValueError(f"Expected an integer, got {value}")
+            return int(value)
+        if isinstance(default, float) and isinstance(value, (int, float)):
+            return float(value)
+        return value
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, (list, dict)) or default is None:
+        # fragment_types may be given as "b,y" or as a python literal
+        return ast.literal_eval(value) if value[:1] in "[{(" else [v.strip() for v in value.split(",") if v.strip()]
+    return value
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def get_batch_inputs(row: Dict[str, Any], overrides: Dict[str, Any]) -> SpectraInputs:
+    """Build the SpectraInputs of a PSM from the defaults, the global overrides and the row's own columns."""
+    kwargs = dict(DEFAULT_INPUTS)
+    kwargs.update(overrides)
+    for key, value in row.items():
+        if key in INPUT_FIELDS and key not in ("spectra_text", "spectra_arrays") and not _is_missing(value):
+            kwargs[key] = parse_param_value(value, DEFAULT_INPUTS.get(key))
+
+    if isinstance(row.get("spectra"), str):
+        kwargs["spectra_text"] = row["spectra"]
+    elif not _is_missing(row.get("mzs")) and not _is_missing(row.get("intensities")):
+        kwargs["spectra_arrays"] = (np.asarray(row["mzs"], dtype=np.float64),
+                                    np.asarray(row["intensities"], dtype=np.float64))
+    elif isinstance(row.get("file"), str):
+        scan = int(row["scan"])
+        kwargs["spectra_arrays"] = read_scan_from_path(row["file"], scan)
+        kwargs["spectra_source"] = f"{os.path.basename(row['file'])}:{scan}"
+    else:
+        raise ValueError("Row needs a 'spectra' column, 'mzs' and 'intensities' columns or 'file' and 'scan' columns")
+
+    if kwargs["color_dict"] is None:
+        default_color_dict = get_color_dict(kwargs["min_charge"], kwargs["max_charge"])
+        kwargs["color_dict"] = {key: color for key, color in default_color_dict.items()
+                                if key == 'unassigned' or key.lstrip('+') in kwargs["fragment_types"]}
+
+    return SpectraInputs(**kwargs)
+
+
+def get_psm_metrics(params: SpectraInputs, fragments: list[pt.Fragment], fragment_matches: list,
+                    spectra_df: pd.DataFrame) -> Dict[str, Any]:
+    """Summary metrics of an annotated spectrum (the app's header metrics plus coverage and error stats)."""
+    match_df = spectra_df[spectra_df["matched"]]
+    total_intensity = float(spectra_df["intensity"].sum())
+
+    # backbone bonds explained by a terminal fragment: a/b/c ions end at, x/y/z ions start after the cleavage
+    terminal_df = match_df[~match_df["internal"].fillna(False).astype(bool)]
+    ion_types = terminal_df["ion_type"].astype(str)
+    bonds = np.concatenate([
+        terminal_df.loc[ion_types.isin(list("abc")), "end"].to_numpy(dtype=np.int64) - 1,
+        terminal_df.loc[ion_types.isin(list("xyz")), "start"].to_numpy(dtype=np.int64) - 1,
+    ])
+    covered = np.zeros(max(len(params.unmodified_sequence) - 1, 0), dtype=bool)
+    covered[bonds[(bonds >= 0) & (bonds < len(covered))]] = True
+
+    abs_error_ppm = match_df["abs_error_ppm"].to_numpy(dtype=np.float64, na_value=np.nan)
+    abs_error = match_df["abs_error"].to_numpy(dtype=np.float64, na_value=np.nan)
+    has_matches = len(match_df) > 0
+    return {
+        "num_peaks": params.num_peaks,
+        "num_fragments": len(fragments),
+        "num_fragment_matches": len(fragment_matches),
+        "num_matched_peaks": len(match_df),
+        "matched_intensity_percent": float(match_df["intensity"].sum()) / total_intensity * 100
+        if total_intensity > 0 else 0.0,
+        "coverage_percent": float(covered.mean() * 100) if len(covered) > 0 else 0.0,
+        "mean_abs_error_ppm": float(np.nanmean(abs_error_ppm)) if has_matches else np.nan,
+        "median_abs_error_ppm": float(np.nanmedian(abs_error_ppm)) if has_matches else np.nan,
+        "max_abs_error_ppm": float(np.nanmax(abs_error_ppm)) if has_matches else np.nan,
+        "mean_abs_error_th": float(np.nanmean(abs_error)) if has_matches else np.nan,
+    }
+
+
+def get_spectra_figure(params: SpectraInputs, spectra_df: pd.DataFrame):
+    """The annotated spectrum plot (as shown in the app)."""
+    spectra_df = spectra_df.copy()
+    spectra_df["custom_label"] = None
+    return generate_annonated_spectra_plotly(spectra_df, scale=params.y_axis_scale,
+                                             error_scale=params.mass_tolerance_type,
+                                             line_width=params.line_width,
+                                             text_size=params.text_size,
+                                             marker_size=params.marker_size,
+                                             axis_text_size=params.axis_text_size,
+                                             title_text_size=params.title_text_size,
+                                             tick_text_size=params.tick_text_size,
+                                             fig_width=params.fig_width,
+                                             fig_height=params.fig_height,
+                                             hide_error_precentile_labels=params.hide_error_percentile_labels,
+                                             bold_labels=params.bold_labels,
+                                             )
+
+
+def write_spectra_svg(params: SpectraInputs, spectra_df: pd.DataFrame, path: str) -> None:
+    """Write the annotated spectrum plot to an SVG file."""
+    fig = get_spectra_figure(params, spectra_df)
+    fig.write_image(file=path, format="svg", width=params.fig_width, height=params.fig_height, scale=1)
+
+
+def run_annotation(params: SpectraInputs,
+                   fragmenter=get_fragments) -> Tuple[pt.ProFormaAnnotation, list, list, pd.DataFrame]:
+    """
+    Run the app's pipeline for a PSM: fragment the sequence, match the fragments and build spectra_df.
+
+    :param params: The PSM's inputs.
+    :param fragmenter: Fragment generator with get_fragments' signature (e.g. a cached version of it).
+    :return: The parsed sequence, the fragments, the fragment matches and spectra_df.
+    """
+    annotation = pt.parse(params.sequence)
+    if annotation.contains_sequence_ambiguity():
+        raise ValueError("Sequence cannot contain ambiguity")
+
+    fragments = fragmenter(annotation, params.is_monoisotopic, params.fragment_types, params.charges,
+                           params.isotopes, params.losses, params.immonium_ions)
+    fragment_matches = get_fragment_matches(params, fragments)
+    return annotation, fragments, fragment_matches, get_spectra_df(params, fragment_matches)
+
+
+def annotate_psm(index: int, row: Dict[str, Any], overrides: Dict[str, Any],
+                 svg_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Annotate a single PSM. Errors are reported in the 'error' column instead of failing the batch.
+
+    :param index: Row number of the PSM in the input table.
+    :param row: The PSM's row of the input table.
+    :param overrides: Parameters applied to every PSM.
+    :param svg_dir: Directory to write the annotated spectrum to (as <index>.svg), None to skip.
+    :return: The PSM's metrics.
+    """
+    result = {"index": index, "sequence": row.get("sequence"), "error": None}
+    try:
+        params = get_batch_inputs(row, overrides)
+        annotation, fragments, fragment_matches, spectra_df = run_annotation(params)
+        result["mass"] = pt.mass(annotation)
+        result.update(get_psm_metrics(params, fragments, fragment_matches, spectra_df))
+
+        if svg_dir is not None:
+            write_spectra_svg(params, spectra_df, os.path.join(svg_dir, f"{index}.svg"))
+    except Exception as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+    return result
+
+
+def _annotate_chunk(chunk: list, overrides: Dict[str, Any], svg_dir: Optional[str]) -> list:
+    return [annotate_psm(index, row, overrides, svg_dir) for index, row in chunk]
+
+
+def read_psm_table(path: str) -> pd.DataFrame:
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return pd.read_parquet(path)
+    if ext in (".tsv", ".txt"):
+        return pd.read_csv(path, sep="\t")
+    return pd.read_csv(path)
+
+
+def annotate_batch(psm_df: pd.DataFrame, overrides: Optional[Dict[str, Any]] = None, svg_dir: Optional[str] = None,
+                   processes: int = 1, chunk_size: int = 64) -> pd.DataFrame:
+    """
+    Annotate every PSM of a table, optionally across a process pool.
+
+    :param psm_df: One row per PSM (see the module docstring for the columns).
+    :param overrides: Parameters applied to every PSM.
+    :param svg_dir: Directory to write annotated spectra SVGs to, None to skip.
+    :param processes: Number of worker processes, 1 to annotate in this process.
+    :param chunk_size: Number of PSMs sent to a worker at once.
+    :return: Per-PSM metrics, in input order.
+    """
+    overrides = overrides or {}
+    if svg_dir is not None:
+        os.makedirs(svg_dir, exist_ok=True)
+
+    rows = list(enumerate(psm_df.to_dict(orient="records")))
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+    if processes <= 1:
+        results = [_annotate_chunk(chunk, overrides, svg_dir) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(_annotate_chunk, chunks, [overrides] * len(chunks),
+                                        [svg_dir] * len(chunks)))
+
+    return pd.DataFrame([result for chunk in results for result in chunk])
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Annotate a table of PSMs and write per-PSM metrics.")
+    parser.add_argument("psms", help="CSV, TSV or Parquet table of PSMs")
+    parser.add_argument("-o", "--output", required=True, help="Parquet file to write the metrics to")
+    parser.add_argument("--svg-dir", default=None, help="Write an annotated spectrum SVG per PSM to this directory")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Number of PSMs sent to a worker at once")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="Parameter applied to every PSM, e.g. --param mass_tolerance=20 (repeatable)")
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    for param in args.param:
+        key, sep, value = param.partition("=")
+        if not sep or key not in INPUT_FIELDS:
+            parser.error(f"Invalid parameter: {param}")
+        overrides[key] = parse_param_value(value, DEFAULT_INPUTS.get(key))
+
+    psm_df = read_psm_table(args.psms)
+
+    start = time.perf_counter()
+    metrics_df = annotate_batch(psm_df, overrides, args.svg_dir, args.processes, args.chunk_size)
+    elapsed = time.perf_counter() - start
+
+    metrics_df.to_parquet(args.output, index=False)
+
+    num_errors = int(metrics_df["error"].notna().sum()) if len(metrics_df) else 0
+    print(f"Annotated {len(metrics_df)} PSMs ({num_errors} failed) in {elapsed:.2f} s "
+          f"({len(metrics_df) / elapsed if elapsed > 0 else 0.0:.1f} PSMs/second)", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,3 @@
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
 import colorsys
 
 import peptacular as pt
@@ -14,6 +12,8 @@ def convert_color(color, format_type='hex'):
     :return: Color in the specified format
     """
     if format_type == 'hex':
+        import matplotlib.colors as mcolors
+
         return mcolors.to_hex(color)
     elif format_type == 'rgb':
         return f'rgb({int(color[0] * 255)}, {int(color[1] * 255)}, {int(color[2] * 255)})'
@@ -37,23 +37,26 @@ def get_color_for_state(ion, charge, min_charge, max_charge, format_type='hex'):
     :return: Color for the given state
     """
 
+    # matplotlib is only imported when colors are built
+    from matplotlib import cm
+
     # Define colormaps for each category
     colormaps = {
-        'ax': plt.cm.spring,
-        'ay': plt.cm.spring,
-        'az': plt.cm.spring,
-        'bx': plt.cm.spring,
-        'by': plt.cm.spring,
-        'bz': plt.cm.spring,
-        'cx': plt.cm.spring,
-        'cy': plt.cm.spring,
-        'cz': plt.cm.spring,
-        'a': plt.cm.BrBG,
-        'b': plt.cm.winter,
-        'c': plt.cm.PRGn,
-        'x': plt.cm.PuOr,
-        'y': plt.cm.seismic,
-        'z': plt.cm.PRGn,
+        'ax': cm.spring,
+        'ay': cm.spring,
+        'az': cm.spring,
+        'bx': cm.spring,
+        'by': cm.spring,
+        'bz': cm.spring,
+        'cx': cm.spring,
+        'cy': cm.spring,
+        'cz': cm.spring,
+        'a': cm.BrBG,
+        'b': cm.winter,
+        'c': cm.PRGn,
+        'x': cm.PuOr,
+        'y': cm.seismic,
+        'z': cm.PRGn,
     }
 
     def get_pos(c):
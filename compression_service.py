@@ -0,0 +1,109 @@
+"""
+Local compression API (the sidecar at constants.COMP_API), shared by app replicas and the userscript.
+
+    python compression_service.py                 # listens on COMP_API's host and port
+
+POST /compress     {"spectra": "mz intensity\\n..."} or {"mzs": [...], "intensities": [...]}  ->  {"payload": "..."}
+                   optionally "codecs": ["", "GZ", ...] to limit the codecs ('' is the untagged codec)
+POST /decompress   {"payload": "..."}  ->  {"mzs": [...], "intensities": [...]}
+GET  /health
+
+Results are cached in the bounded payload store at constants.COMPRESSION_STORE_PATH, which app replicas without
+a reachable sidecar use directly, so a spectrum is only compressed (or decoded) once.
+"""
+
+import argparse
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlsplit
+
+import constants
+from annotation_util import serialize_sequence
+from compression_util import LocalCompressionApi, PayloadStore
+
+
+class CompressionRequestHandler(BaseHTTPRequestHandler):
+    api: LocalCompressionApi = None
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        # the userscript calls the API from the spectrum viewer's pages
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint: {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ("/compress", "/decompress"):
+            self._send_json(404, {"error": f"Unknown endpoint: {self.path}"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(request, dict):
+                raise ValueError("The request body must be a JSON object")
+
+            if self.path == "/compress":
+                spectra = request.get("spectra")
+                if spectra is None:
+                    spectra = serialize_sequence(list(zip(request["mzs"], request["intensities"])))
+                codecs = request.get("codecs")
+                if codecs is not None and not isinstance(codecs, list):
+                    raise ValueError("'codecs' must be a list")
+                self._send_json(200, {"payload": self.api.compress(str(spectra), codecs)})
+            else:
+                mzs, ints = self.api.decompress(str(request["payload"]))
+                self._send_json(200, {"mzs": mzs.tolist(), "intensities": ints.tolist()})
+        except (ValueError, KeyError, TypeError) as err:
+            self._send_json(400, {"error": f"Invalid request: {err}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str, port: int, store_path: str = constants.COMPRESSION_STORE_PATH,
+          store_size: int = constants.COMPRESSION_STORE_SIZE) -> None:
+    api = LocalCompressionApi(PayloadStore(store_path, store_size))
+    handler = type("Handler", (CompressionRequestHandler,), {"api": api})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Compression service on http://{host}:{port} (store: {store_path})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv: Optional[list] = None) -> int:
+    api_url = urlsplit(constants.COMP_API or "http://127.0.0.1:8000")
+    parser = argparse.ArgumentParser(description="Run the local compression API.")
+    parser.add_argument("--host", default=api_url.hostname)
+    parser.add_argument("--port", type=int, default=api_url.port or 8000)
+    parser.add_argument("--store", default=constants.COMPRESSION_STORE_PATH, help="Payload store (SQLite file)")
+    parser.add_argument("--store-size", type=int, default=constants.COMPRESSION_STORE_SIZE,
+                        help="Maximum number of cached payloads")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.store, args.store_size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
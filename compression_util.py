@@ -0,0 +1,270 @@
+"""
+Spectra compression for permalinks: the URL codecs, a bounded payload store shared by processes and the
+compression API (in-process, or the compression_service.py sidecar at constants.COMP_API).
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import constants
+from annotation_util import RAW_SPECTRA_PREFIX, decode_raw_spectra, parse_spectra
+
+# URL codec payload tags ('<tag>:<payload>'), untagged payloads use SpectrumCompressorUrl
+URL_CODECS = ["GZ", "FL", "I4", "I3"]
+
+# codecs grouped by precision level, most precise first
+# (float32 | lossy intensity | m/z to 1e-4 | m/z to 1e-3, the lossy intensities are within ~5-8%)
+URL_CODEC_LEVELS = [["", "GZ"], ["FL"], ["I4"], ["I3"]]
+
+# what the lossy codecs change, shown to users of a link that uses one
+LOSSY_URL_CODECS = {
+    "FL": "intensities within ~5-8%",
+    "I4": "m/z rounded to 4 decimals",
+    "I3": "m/z rounded to 3 decimals",
+}
+
+
+@lru_cache(maxsize=None)
+def get_url_codec(codec: str = ""):
+    """The compressor of a URL codec tag, msms_compression is only imported once a codec is used."""
+    from msms_compression import BaseCompressor, BrotliCompressor, GzipCompressor, SpectrumCompressorF32, \
+        SpectrumCompressorF32Lossy, SpectrumCompressorI32, SpectrumCompressorUrl, UrlEncoder
+
+    if codec == "GZ":
+        return BaseCompressor(SpectrumCompressorF32(), GzipCompressor(), UrlEncoder())
+    if codec == "FL":
+        return BaseCompressor(SpectrumCompressorF32Lossy(2), BrotliCompressor(), UrlEncoder())
+    if codec == "I4":
+        return BaseCompressor(SpectrumCompressorI32(4, 1), BrotliCompressor(), UrlEncoder())
+    if codec == "I3":
+        return BaseCompressor(SpectrumCompressorI32(3, 1), BrotliCompressor(), UrlEncoder())
+    return SpectrumCompressorUrl
+
+
+def encode_spectra(mzs: List[float], intensities: List[float], codec: str = "") -> str:
+    """Encode spectra for the URL with a single codec, tagging the payload with the codec used."""
+    if not codec:
+        return get_url_codec().compress(mzs, intensities)
+    return f"{codec}:{get_url_codec(codec).compress(mzs, intensities)}"
+
+
+def encode_spectra_adaptive(mzs: List[float], intensities: List[float],
+                            max_length: int = constants.URL_SPECTRA_MAX_LENGTH,
+                            time_budget: float = constants.URL_COMPRESSION_TIME_BUDGET,
+                            codecs: Optional[List[str]] = None) -> str:
+    """
+    Encode spectra for the URL, picking the codec by payload length.
+
+    Precision levels are tried most precise first, and the smallest payload of the first level that fits under
+    max_length is returned. Once time_budget (seconds) is spent the smallest payload so far is returned, even if
+    it is longer than max_length. codecs limits the codecs tried ('' is the untagged SpectrumCompressorUrl).
+    """
+    start = time.perf_counter()
+    best = None
+    for level in URL_CODEC_LEVELS:
+        for codec in level:
+            if codecs is not None and codec not in codecs:
+                continue
+            if best is not None and time.perf_counter() - start > time_budget:
+                return best
+            try:
+                payload = encode_spectra(mzs, intensities, codec)
+            except (ValueError, OverflowError):  # lossy codecs log-transform intensities (fails on zeros)
+                continue
+            if best is None or len(payload) < len(best):
+                best = payload
+        if best is not None and len(best) <= max_length:
+            return best
+    return best
+
+
+def get_payload_codec(payload: str) -> str:
+    """The codec tag of a URL payload, '' for untagged payloads."""
+    codec, sep, _ = payload.partition(":")
+    return codec if sep and codec in URL_CODECS else ""
+
+
+def decode_payload(payload: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode a URL payload (RAW, tagged or untagged) into m/z and intensity arrays."""
+    if payload.startswith(RAW_SPECTRA_PREFIX):
+        return decode_raw_spectra(payload)
+
+    codec = get_payload_codec(payload)
+    if codec:
+        mzs, ints = get_url_codec(codec).decompress(payload[len(codec) + 1:])
+    else:
+        mzs, ints = get_url_codec().decompress(payload)
+    return np.array(mzs, dtype=np.float64), np.array(ints, dtype=np.float64)
+
+
+class PayloadStore:
+    """
+    Bounded key-value store in a SQLite file, shared by every process (app replicas, the sidecar) that opens it.
+
+    Least recently used entries are evicted once the store holds more than max_entries. Store errors (e.g. a
+    read-only or locked file) are treated as misses, the store is only a cache.
+    """
+
+    def __init__(self, path: str, max_entries: int, evict_every: int = 64):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._puts = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS payloads (namespace TEXT, key TEXT, value BLOB, "
+                               "accessed REAL, PRIMARY KEY (namespace, key))")
+            connection.execute("CREATE INDEX IF NOT EXISTS payloads_accessed ON payloads (accessed)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT value FROM payloads WHERE namespace = ? AND key = ?",
+                                     (namespace, key)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE payloads SET accessed = ? WHERE namespace = ? AND key = ?",
+                               (time.time(), namespace, key))
+            return row[0]
+        except sqlite3.Error:
+            return None
+
+    def put(self, namespace: str, key: str, value: bytes) -> None:
+        try:
+            connection = self._connection()
+            connection.execute("INSERT OR REPLACE INTO payloads VALUES (?, ?, ?, ?)",
+                               (namespace, key, value, time.time()))
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self.evict()
+        except sqlite3.Error:
+            pass
+
+    def evict(self) -> None:
+        connection = self._connection()
+        (count,) = connection.execute("SELECT COUNT(*) FROM payloads").fetchone()
+        if count > self.max_entries:
+            connection.execute("DELETE FROM payloads WHERE rowid IN "
+                               "(SELECT rowid FROM payloads ORDER BY accessed LIMIT ?)", (count - self.max_entries,))
+
+
+def _content_key(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class LocalCompressionApi:
+    """The compression API in-process, with results cached in a (shared) PayloadStore."""
+
+    def __init__(self, store: Optional[PayloadStore] = None):
+        self.store = store
+
+    def compress(self, spectra_text: str, codecs: Optional[List[str]] = None) -> str:
+        """
+        Compress 'm/z intensity' text into a URL payload. Raises a ValueError for invalid spectra.
+
+        :param spectra_text: The spectrum as 'm/z intensity' lines.
+        :param codecs: Codecs that may be used (URL_CODECS tags, '' for the untagged codec), None for all of them.
+        :return: The URL payload.
+        """
+        if codecs is not None:
+            unknown = sorted(map(str, set(codecs) - {""} - set(URL_CODECS)))
+            if unknown or not codecs:
+                raise ValueError(f"Invalid codecs {unknown or codecs}, expected some of: '', {', '.join(URL_CODECS)}")
+            codecs = sorted(set(codecs))
+
+        key = _content_key(spectra_text if codecs is None else f"{','.join(codecs)}\n{spectra_text}")
+        cached = self.store.get("compress", key) if self.store else None
+        if cached is not None:
+            return cached.decode()
+
+        mzs, ints = parse_spectra(spectra_text)
+        payload = encode_spectra_adaptive(mzs.tolist(), ints.tolist(), codecs=codecs)
+        if self.store:
+            self.store.put("compress", key, payload.encode())
+        return payload
+
+    def decompress(self, payload: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Decode a URL payload into m/z and intensity arrays. Raises a ValueError for invalid payloads."""
+        key = _content_key(payload)
+        cached = self.store.get("decompress", key) if self.store else None
+        if cached is not None:
+            values = np.frombuffer(cached, dtype=np.float64).reshape(2, -1)
+            return values[0].copy(), values[1].copy()
+
+        mzs, ints = decode_payload(payload)
+        if self.store:
+            self.store.put("decompress", key, np.stack([mzs, ints]).tobytes())
+        return mzs, ints
+
+
+class CompressionApiClient:
+    """
+    Client of the compression sidecar (compression_service.py), with the same interface as LocalCompressionApi.
+
+    If the sidecar cannot be reached the fallback is used, and the sidecar is not tried again for retry_after
+    seconds.
+    """
+
+    def __init__(self, api_url: str, fallback: LocalCompressionApi, timeout: float = constants.COMP_API_TIMEOUT,
+                 retry_after: float = 30.0):
+        self.api_url = api_url.rstrip("/")
+        self.fallback = fallback
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._unavailable_until = 0.0
+
+    def _post(self, endpoint: str, body: dict) -> Optional[dict]:
+        """POST to the sidecar, None if it is unavailable. Requests it rejects raise a ValueError."""
+        if time.monotonic() < self._unavailable_until:
+            return None
+
+        request = urllib.request.Request(f"{self.api_url}{endpoint}", data=json.dumps(body).encode(),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as err:
+            if err.code == 400:
+                raise ValueError(json.loads(err.read()).get("error", "invalid request")) from err
+            self._unavailable_until = time.monotonic() + self.retry_after
+        except (OSError, ValueError):
+            self._unavailable_until = time.monotonic() + self.retry_after
+        return None
+
+    def compress(self, spectra_text: str, codecs: Optional[List[str]] = None) -> str:
+        body = {"spectra": spectra_text} if codecs is None else {"spectra": spectra_text, "codecs": codecs}
+        response = self._post("/compress", body)
+        if response is None:
+            return self.fallback.compress(spectra_text, codecs)
+        return response["payload"]
+
+    def decompress(self, payload: str) -> Tuple[np.ndarray, np.ndarray]:
+        response = self._post("/decompress", {"payload": payload})
+        if response is None:
+            return self.fallback.decompress(payload)
+        return np.array(response["mzs"], dtype=np.float64), np.array(response["intensities"], dtype=np.float64)
+
+
+@lru_cache(maxsize=None)
+def get_compression_api():
+    """The sidecar at constants.COMP_API if one is configured, otherwise the in-process API (same store)."""
+    local_api = LocalCompressionApi(PayloadStore(constants.COMPRESSION_STORE_PATH, constants.COMPRESSION_STORE_SIZE))
+    if constants.COMP_API:
+        return CompressionApiClient(constants.COMP_API, local_api)
+    return local_api
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 def get_env_int(var_name, default):
@@ -47,7 +48,10 @@ DEFAULT_MIN_MZ = 0.0
 DEFAULT_MAX_MZ = 10_000.0
 DEFAULT_BOTTOM_N_PEAKS = 0
 DEFAULT_TOP_N_PEAKS = 1_000_000
+DEFAULT_PEAK_WINDOW = 0.0
 DEFAULT_IMMONIUM_IONS = True
+DEFAULT_ANNOTATION_TOP_N = 50
+DEFAULT_ANNOTATION_SEARCH_TOLERANCE = 1.0
 MAX_CHARGE_STATES = 10
 
 COLOR_DICT = {'+i': 'mediumvioletred', '++i': 'palevioletred', '+++i': 'hotpink', '++++i': 'hotpink',
@@ -77,8 +81,33 @@ IONS = ['a', 'b', 'c', 'x', 'y', 'z']
 INTERNAL_IONS = ['ax', 'ay', 'az', 'bx', 'by', 'bz', 'cx', 'cy', 'cz']
 BASE_URL = get_env_str('BASE_URL', 'https://spectrum-viewer-dev.streamlit.app/')
 COMP_API = get_env_str('COMP_API', 'http://127.0.0.1:8000')
+SPECTRUM_STORE_DIR = get_env_str('SPECTRUM_STORE_DIR', os.path.join(tempfile.gettempdir(), 'spectrum_viewer_store'))
+SPECTRUM_STORE_MAX_SIZE = get_env_int('SPECTRUM_STORE_MAX_SIZE', 4 * 1024 ** 3)  # bytes
 
 VALID_COMPRESSION_ALGORITHMS = ['lzstring', 'brotli', 'lossy']
+URL_SPECTRA_MAX_LENGTH = get_env_int('URL_SPECTRA_MAX_LENGTH', 8000)  # characters
+URL_COMPRESSION_TIME_BUDGET = get_env_float('URL_COMPRESSION_TIME_BUDGET', 1.0)  # seconds
+DECONVOLUTION_TIMEOUT = get_env_float('DECONVOLUTION_TIMEOUT', 30.0)  # seconds
+DECONVOLUTION_WORKERS = get_env_int('DECONVOLUTION_WORKERS', 2)
+DECONVOLUTION_CACHE_SIZE = get_env_int('DECONVOLUTION_CACHE_SIZE', 256)
+SPECTRA_CACHE_SIZE = get_env_int('SPECTRA_CACHE_SIZE', 256)
+ANNOTATION_PAGE_SIZE = get_env_int('ANNOTATION_PAGE_SIZE', 100)  # rows
+ANNOTATE_SERVICE_HOST = get_env_str('ANNOTATE_SERVICE_HOST', '127.0.0.1')
+ANNOTATE_SERVICE_PORT = get_env_int('ANNOTATE_SERVICE_PORT', 8001)
+ANNOTATE_SERVICE_WORKERS = get_env_int('ANNOTATE_SERVICE_WORKERS', os.cpu_count() or 1)
+ANNOTATE_SERVICE_CACHE_SIZE = get_env_int('ANNOTATE_SERVICE_CACHE_SIZE', 1024)  # responses
+ANNOTATE_SERVICE_TIMEOUT = get_env_float('ANNOTATE_SERVICE_TIMEOUT', 60.0)  # seconds
+ANNOTATE_SERVICE_DATA_DIR = get_env_str('ANNOTATE_SERVICE_DATA_DIR', '')  # 'file' PSMs are read from here only
+COMP_API_TIMEOUT = get_env_float('COMP_API_TIMEOUT', 2.0)  # seconds
+COMPRESSION_STORE_PATH = get_env_str('COMPRESSION_STORE_PATH',
+                                     os.path.join(tempfile.gettempdir(), 'spectrum_viewer_compression.sqlite'))
+COMPRESSION_STORE_SIZE = get_env_int('COMPRESSION_STORE_SIZE', 10_000)  # payloads
+SHORT_URL_MODE = get_env_str('SHORT_URL_MODE', 'tinyurl')  # 'tinyurl' or 'local'
+SHORT_URL_TIMEOUT = get_env_float('SHORT_URL_TIMEOUT', 5.0)  # seconds
+SHORT_LINK_STORE_PATH = get_env_str('SHORT_LINK_STORE_PATH',
+                                    os.path.join(tempfile.gettempdir(), 'spectrum_viewer_short_links.sqlite'))
+PERMALINK_STORE_PATH = get_env_str('PERMALINK_STORE_PATH',
+                                   os.path.join(tempfile.gettempdir(), 'spectrum_viewer_permalinks.sqlite'))
 
 if COMP_API != '':
     VALID_COMPRESSION_ALGORITHMS.append('key')
@@ -318,14 +347,28 @@ MAX_MZ_HELP = "Set the maximum m/z value to be considered in the analysis."
 
 SPECTRA_HELP = "Enter the MS2 spectra data in the format 'm/z intensity', each pair on a new line."
 
+SPECTRA_FILE_HELP = "Upload an MGF, MS2 or mzML file to annotate one of its scans. While a file is loaded the pasted spectra are ignored."
+
+SPECTRA_FILE_SCAN_HELP = "Scan number of the spectrum to load from the uploaded file."
+
 TOP_N_HELP = "Set the number of top peaks to be considered in the analysis."
 
 BOTTOM_N_HELP = "Set the number of bottom peaks to be considered in the analysis."
 
+PEAK_WINDOW_HELP = "Apply the top/bottom peak counts per m/z window of this width (e.g. top 10 per 100 Th). Set to 0 to apply them to the whole spectrum."
+
 IMMONIUM_IONS_HELP = "Check this box to include immonium ions in the analysis."
 
 TEXT_SIZE_HELP = "Set the text size for labels in the graph."
 
 LINE_WIDTH_HELP = "Set the line width for the graph."
 
-MARKER_SIZE_HELP = "Set the marker size for peaks in the graph."
\ No newline at end of file
+MARKER_SIZE_HELP = "Set the marker size for peaks in the graph."
+
+ANNOTATION_TOP_N_HELP = "Number of most intense peaks shown in the custom annotation editor (in addition to the matched and already annotated peaks)."
+
+ANNOTATION_SEARCH_MZ_HELP = "Show the peaks around this m/z in the custom annotation editor instead. Set to 0 to disable the search."
+
+ANNOTATION_SEARCH_TOLERANCE_HELP = "m/z tolerance of the custom annotation search."
+
+ANNOTATION_PAGE_HELP = "Page of the custom annotation editor."
@@ -0,0 +1,532 @@
+import base64
+import os
+import re
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+
+import numpy as np
+
+SPECTRA_FILE_FORMATS = ["mgf", "ms2", "mzml"]
+
+
+@dataclass(frozen=True)
+class ScanInfo:
+    """Location and precursor information of a single spectrum inside a spectra file."""
+    scan: int
+    precursor_mz: Optional[float]
+    charge: Optional[int]
+    rt: Optional[float]  # retention time in seconds
+    offset: int  # byte offset of the spectrum block
+    length: int  # byte length of the spectrum block
+
+
+def get_file_format(filename: str) -> str:
+    """Get the spectra file format from the file extension."""
+    extension = filename.rsplit(".", 1)[-1].lower()
+    if extension not in SPECTRA_FILE_FORMATS:
+        raise ValueError(f"Unsupported spectra file type: {extension}")
+    return extension
+
+
+def _lines_with_offsets(fh: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    """Yield (byte offset, line) pairs while streaming through a binary file."""
+    fh.seek(0)
+    offset = 0
+    for line in fh:
+        yield offset, line
+        offset += len(line)
+
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _first_int(value: Optional[str]) -> Optional[int]:
+    """Parse the first integer of values like '2', '2+', '+2', '2+ and 3+' or '1234-1240'."""
+    if value is None:
+        return None
+    match = re.search(r"\d+", value)
+    return int(match.group()) if match else None
+
+
+_MGF_TITLE_SCAN_PATTERNS = [re.compile(r"scan=(\d+)"), re.compile(r"\.(\d+)\.\d+\.\d+\s*$")]
+
+
+def _mgf_scan_from_title(title: str) -> Optional[int]:
+    for pattern in _MGF_TITLE_SCAN_PATTERNS:
+        match = pattern.search(title)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _index_mgf(fh: BinaryIO) -> List[ScanInfo]:
+    index, headers, start = [], {}, None
+    for offset, raw_line in _lines_with_offsets(fh):
+        if raw_line[:1].isdigit():  # peak lines are skipped without parsing
+            continue
+
+        line = raw_line.strip()
+        if line == b"BEGIN IONS":
+            headers, start = {}, offset
+        elif line == b"END IONS" and start is not None:
+            scan = _first_int(headers.get("SCANS")) or _mgf_scan_from_title(headers.get("TITLE", ""))
+            pepmass = headers.get("PEPMASS", "").split()
+            index.append(ScanInfo(
+                scan=scan if scan is not None else len(index) + 1,
+                precursor_mz=_to_float(pepmass[0]) if pepmass else None,
+                charge=_first_int(headers.get("CHARGE")),
+                rt=_to_float(headers.get("RTINSECONDS")),
+                offset=start,
+                length=offset + len(raw_line) - start,
+            ))
+            start = None
+        elif start is not None and b"=" in line:
+            key, value = line.decode("utf-8", errors="replace").split("=", 1)
+            headers[key.upper()] = value
+    return index
+
+
+def _index_ms2(fh: BinaryIO) -> List[ScanInfo]:
+    index, current = [], None
+
+    def close(end: int):
+        if current is not None:
+            index.append(ScanInfo(length=end - current["offset"], **current))
+
+    end = 0
+    for offset, line in _lines_with_offsets(fh):
+        end = offset + len(line)
+        if line[:1].isdigit():
+            continue
+
+        parts = line.decode("utf-8", errors="replace").split()
+        if not parts:
+            continue
+
+        if parts[0] == "S":
+            close(offset)
+            current = dict(scan=int(parts[1]), precursor_mz=_to_float(parts[3]) if len(parts) > 3 else None,
+                           charge=None, rt=None, offset=offset)
+        elif current is not None and parts[0] == "Z" and current["charge"] is None:
+            current["charge"] = _first_int(parts[1])
+        elif current is not None and parts[0] == "I" and len(parts) > 2 and parts[1] == "RetTime":
+            rt = _to_float(parts[2])
+            current["rt"] = rt * 60 if rt is not None else None  # MS2 retention times are in minutes
+    close(end)
+    return index
+
+
+_MZML_SPECTRUM_START = re.compile(rb"<spectrum[\s>]")
+_MZML_SPECTRUM_END = re.compile(rb"</spectrum>")
+_MZML_ID_SCAN = re.compile(rb'\sid="[^"]*scan=(\d+)')
+_MZML_INDEX = re.compile(rb'\sindex="(\d+)"')
+_MZML_CV_PARAM = re.compile(rb'<cvParam[^>]*accession="(MS:\d+)"[^>]*?value="([^"]*)"(?:[^>]*unitName="([^"]*)")?')
+
+
+def _index_mzml(fh: BinaryIO) -> List[ScanInfo]:
+    index, current = [], None
+    for offset, line in _lines_with_offsets(fh):
+        text, text_offset = line, offset
+        if current is None:
+            match = _MZML_SPECTRUM_START.search(line)
+            if match is None:
+                continue
+            scan = _MZML_ID_SCAN.search(line)
+            spectrum_index = _MZML_INDEX.search(line)
+            if scan:
+                scan = int(scan.group(1))
+            elif spectrum_index:
+                scan = int(spectrum_index.group(1)) + 1
+            current = dict(scan=scan, precursor_mz=None, charge=None, rt=None, offset=offset + match.start())
+            text, text_offset = line[match.start():], offset + match.start()
+
+        end = _MZML_SPECTRUM_END.search(text)
+        if end is not None:
+            text = text[:end.end()]
+
+        if b"<binary>" in text:  # the encoded peak arrays are never needed for the index
+            text = re.sub(rb"<binary>.*?(</binary>|$)", b"", text, flags=re.S)
+
+        for accession, value, unit in _MZML_CV_PARAM.findall(text):
+            if accession == b"MS:1000744" and current["precursor_mz"] is None:  # selected ion m/z
+                current["precursor_mz"] = _to_float(value)
+            elif accession == b"MS:1000041" and current["charge"] is None:  # charge state
+                current["charge"] = _first_int(value.decode())
+            elif accession == b"MS:1000016":  # scan start time
+                rt = _to_float(value)
+                current["rt"] = rt * 60 if rt is not None and unit == b"minute" else rt
+
+        if end is not None:
+            if current["scan"] is None:
+                current["scan"] = len(index) + 1
+            index.append(ScanInfo(length=text_offset + end.end() - current["offset"], **current))
+            current = None
+    return index
+
+
+_INDEXERS = {
+    "mgf": _index_mgf,
+    "ms2": _index_ms2,
+    "mzml": _index_mzml,
+}
+
+
+def build_scan_index(fh: BinaryIO, file_format: str) -> List[ScanInfo]:
+    """
+    Stream through a spectra file and record where every spectrum starts, without decoding any peaks.
+
+    :param fh: Binary file handle (must support seek).
+    :param file_format: One of 'mgf', 'ms2' or 'mzml'.
+    :return: Scan index in file order.
+    """
+    return _INDEXERS[file_format](fh)
+
+
+SCAN_INDEX_DTYPE = np.dtype([
+    ("scan", "<i8"),
+    ("precursor_mz", "<f8"),  # NaN if missing
+    ("charge", "<i2"),  # 0 if missing
+    ("rt", "<f8"),  # NaN if missing
+    ("offset", "<i8"),
+    ("length", "<i8"),
+])
+
+
+class ScanIndex:
+    """Array backed scan index, either held in memory or memory-mapped from a sidecar file."""
+
+    def __init__(self, records: np.ndarray):
+        self.records = records
+        self._order = np.argsort(records["scan"], kind="stable")
+        self._sorted_scans = records["scan"][self._order]
+
+    @classmethod
+    def from_scan_infos(cls, scan_infos: List[ScanInfo]) -> "ScanIndex":
+        records = np.empty(len(scan_infos), dtype=SCAN_INDEX_DTYPE)
+        for i, s in enumerate(scan_infos):
+            records[i] = (s.scan,
+                          s.precursor_mz if s.precursor_mz is not None else np.nan,
+                          s.charge or 0,
+                          s.rt if s.rt is not None else np.nan,
+                          s.offset,
+                          s.length)
+        return cls(records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, i: int) -> ScanInfo:
+        record = self.records[i]
+        return ScanInfo(
+            scan=int(record["scan"]),
+            precursor_mz=None if np.isnan(record["precursor_mz"]) else float(record["precursor_mz"]),
+            charge=int(record["charge"]) or None,
+            rt=None if np.isnan(record["rt"]) else float(record["rt"]),
+            offset=int(record["offset"]),
+            length=int(record["length"]),
+        )
+
+    @property
+    def min_scan(self) -> int:
+        return int(self._sorted_scans[0])
+
+    @property
+    def max_scan(self) -> int:
+        return int(self._sorted_scans[-1])
+
+    def position(self, scan: int) -> Optional[int]:
+        """Position of a scan in file order, returns None if the file has no such scan."""
+        i = np.searchsorted(self._sorted_scans, scan)
+        if i == len(self._sorted_scans) or self._sorted_scans[i] != scan:
+            return None
+        return int(self._order[i])
+
+    def find(self, scan: int) -> Optional[ScanInfo]:
+        """Look up a scan by its scan number, returns None if the file has no such scan."""
+        i = self.position(scan)
+        return None if i is None else self[i]
+
+
+# sidecar layout: magic, then the indexed file's size and mtime (ns), then the raw SCAN_INDEX_DTYPE records
+_SIDECAR_MAGIC = b"SSVSCANIDX1\n"
+_SIDECAR_HEADER = struct.Struct("<qq")
+_SIDECAR_OFFSET = len(_SIDECAR_MAGIC) + _SIDECAR_HEADER.size
+SIDECAR_EXTENSION = ".scanidx"
+
+
+def _read_sidecar(sidecar_path: str, file_size: int, file_mtime_ns: int) -> Optional[ScanIndex]:
+    try:
+        with open(sidecar_path, "rb") as fh:
+            header = fh.read(_SIDECAR_OFFSET)
+        sidecar_size = os.path.getsize(sidecar_path)
+    except OSError:
+        return None
+
+    if len(header) != _SIDECAR_OFFSET or not header.startswith(_SIDECAR_MAGIC):
+        return None
+    if _SIDECAR_HEADER.unpack_from(header, len(_SIDECAR_MAGIC)) != (file_size, file_mtime_ns):
+        return None  # stale, the spectra file changed since the index was built
+    if (sidecar_size - _SIDECAR_OFFSET) % SCAN_INDEX_DTYPE.itemsize:
+        return None
+    if sidecar_size == _SIDECAR_OFFSET:
+        return ScanIndex(np.empty(0, dtype=SCAN_INDEX_DTYPE))
+    return ScanIndex(np.memmap(sidecar_path, dtype=SCAN_INDEX_DTYPE, mode="r", offset=_SIDECAR_OFFSET))
+
+
+def _write_sidecar(sidecar_path: str, scan_index: ScanIndex, file_size: int, file_mtime_ns: int):
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(_SIDECAR_MAGIC)
+        fh.write(_SIDECAR_HEADER.pack(file_size, file_mtime_ns))
+        fh.write(scan_index.records.tobytes())
+    os.replace(tmp_path, sidecar_path)
+
+
+def open_scan_index(path: str, file_format: Optional[str] = None) -> ScanIndex:
+    """
+    Open the scan index of a spectra file on disk.
+
+    The index is built once and saved next to the file as a '.scanidx' sidecar, later opens memory-map the
+    sidecar instead of re-scanning the file. The sidecar is rebuilt if the file's size or mtime changed, and
+    the index is only kept in memory if the sidecar cannot be written.
+
+    :param path: Path to an MGF, MS2 or mzML file.
+    :param file_format: File format, inferred from the extension if not given.
+    :return: Scan index of the file.
+    """
+    file_format = file_format or get_file_format(path)
+    stat = os.stat(path)
+    sidecar_path = path + SIDECAR_EXTENSION
+
+    scan_index = _read_sidecar(sidecar_path, stat.st_size, stat.st_mtime_ns)
+    if scan_index is not None:
+        return scan_index
+
+    with open(path, "rb") as fh:
+        scan_index = ScanIndex.from_scan_infos(build_scan_index(fh, file_format))
+
+    try:
+        _write_sidecar(sidecar_path, scan_index, stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        pass
+    return scan_index
+
+
+def _parse_peak_lines(lines: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    """Parse 'mz intensity [...]' lines, ignoring any extra columns."""
+    values = [line.split()[:2] for line in lines if line[:1].isdigit()]
+    if not values:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+    values = np.array(values, dtype=np.float64)
+    return values[:, 0].copy(), values[:, 1].copy()
+
+
+_MZML_FLOAT_TYPES = {"MS:1000521": "<f4", "MS:1000523": "<f8"}
+_MZML_ARRAY_TYPES = {"MS:1000514": "mz", "MS:1000515": "intensity"}
+_MZML_NUMPRESS = {"MS:1002312", "MS:1002313", "MS:1002314", "MS:1002746", "MS:1002747", "MS:1002748"}
+
+
+def _decode_binary_data_array(element: ElementTree.Element) -> Tuple[Optional[str], np.ndarray]:
+    accessions = {cv.get("accession") for cv in element.iter("cvParam")}
+    array_type = next((_MZML_ARRAY_TYPES[a] for a in accessions if a in _MZML_ARRAY_TYPES), None)
+    dtype = next((_MZML_FLOAT_TYPES[a] for a in accessions if a in _MZML_FLOAT_TYPES), "<f8")
+
+    if accessions & _MZML_NUMPRESS:
+        raise ValueError("MS-Numpress compressed mzML arrays are not supported")
+
+    data = base64.b64decode((element.findtext("binary") or "").strip())
+    if "MS:1000574" in accessions:  # zlib compression
+        data = zlib.decompress(data)
+    return array_type, np.frombuffer(data, dtype=dtype).astype(np.float64)
+
+
+def _parse_mzml_spectrum(block: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    # the block is cut out of a document with a default namespace, so its tags are un-prefixed
+    spectrum = ElementTree.fromstring(block)
+    arrays = dict(_decode_binary_data_array(e) for e in spectrum.iter("binaryDataArray"))
+    mzs = arrays.get("mz", np.empty(0, dtype=np.float64))
+    intensities = arrays.get("intensity", np.zeros_like(mzs))
+    if len(mzs) != len(intensities):
+        raise ValueError(f"{len(mzs)} m/z values but {len(intensities)} intensities")
+    return mzs, intensities
+
+
+def read_scan(fh: BinaryIO, scan_info: ScanInfo, file_format: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Seek to a single indexed spectrum and decode its m/z and intensity arrays, a ValueError if it is malformed."""
+    fh.seek(scan_info.offset)
+    block = fh.read(scan_info.length)
+
+    try:
+        if file_format == "mzml":
+            return _parse_mzml_spectrum(block)
+        return _parse_peak_lines(block.splitlines())
+    except (ValueError, zlib.error, ElementTree.ParseError) as e:
+        raise ValueError(f"Invalid scan {scan_info.scan}: {e}") from e
+
+
+def read_scan_from_path(path: str, scan: int, file_format: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Read a single scan of a spectra file on disk, using (and creating if needed) its index sidecar."""
+    file_format = file_format or get_file_format(path)
+    scan_info = open_scan_index(path, file_format).find(scan)
+    if scan_info is None:
+        raise ValueError(f"Scan {scan} not found in {path}")
+    with open(path, "rb") as fh:
+        return read_scan(fh, scan_info, file_format)
+
+
+# store layout: scan index records, per scan peak offsets (n + 1), then the concatenated peak arrays of all scans
+_STORE_SCANS = "scans.npy"
+_STORE_OFFSETS = "offsets.npy"
+_STORE_MZS = "mz.f8"
+_STORE_INTENSITIES = "intensity.f4"
+_STORE_TMP_SUFFIX = ".tmp"
+
+
+class SpectrumStore:
+    """Columnar, memory-mapped store of every spectrum in a run."""
+
+    def __init__(self, scan_index: ScanIndex, offsets: np.ndarray, mzs: np.ndarray, intensities: np.ndarray):
+        self.scan_index = scan_index
+        self.offsets = offsets
+        self.mzs = mzs
+        self.intensities = intensities
+
+    def __len__(self) -> int:
+        return len(self.scan_index)
+
+    def get(self, scan: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Zero-copy m/z (float64) and intensity (float32) views of a scan, None if the run has no such scan."""
+        i = self.scan_index.position(scan)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mzs[start:end], self.intensities[start:end]
+
+
+def _memmap_array(path: str, dtype: str, count: int) -> np.ndarray:
+    if count == 0:  # zero length files cannot be memory-mapped
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def open_spectrum_store(store_dir: str) -> SpectrumStore:
+    """Memory-map a spectrum store written by write_spectrum_store."""
+    records = np.load(os.path.join(store_dir, _STORE_SCANS))
+    offsets = np.load(os.path.join(store_dir, _STORE_OFFSETS))
+    return SpectrumStore(
+        scan_index=ScanIndex(records),
+        offsets=offsets,
+        mzs=_memmap_array(os.path.join(store_dir, _STORE_MZS), "<f8", int(offsets[-1])),
+        intensities=_memmap_array(os.path.join(store_dir, _STORE_INTENSITIES), "<f4", int(offsets[-1])),
+    )
+
+
+def write_spectrum_store(fh: BinaryIO, file_format: str, store_dir: str) -> SpectrumStore:
+    """
+    Transcode a spectra file into a columnar spectrum store, decoding every scan exactly once.
+
+    :param fh: Binary file handle (must support seek).
+    :param file_format: One of 'mgf', 'ms2' or 'mzml'.
+    :param store_dir: Directory to write the store to, moved into place atomically once complete.
+    :return: The memory-mapped store.
+    """
+    scan_index = ScanIndex.from_scan_infos(build_scan_index(fh, file_format))
+    offsets = np.zeros(len(scan_index) + 1, dtype=np.int64)
+
+    # unique per call: threads of one process may convert the same content concurrently
+    tmp_dir = tempfile.mkdtemp(prefix=f"{os.path.basename(store_dir)}.", suffix=_STORE_TMP_SUFFIX,
+                               dir=os.path.dirname(store_dir) or None)
+    try:
+        with open(os.path.join(tmp_dir, _STORE_MZS), "wb") as mz_fh, \
+                open(os.path.join(tmp_dir, _STORE_INTENSITIES), "wb") as intensity_fh:
+            for i in range(len(scan_index)):
+                mzs, intensities = read_scan(fh, scan_index[i], file_format)
+                mz_fh.write(mzs.astype("<f8", copy=False).tobytes())
+                intensity_fh.write(intensities.astype("<f4").tobytes())
+                offsets[i + 1] = offsets[i] + len(mzs)
+        np.save(os.path.join(tmp_dir, _STORE_SCANS), scan_index.records)
+        np.save(os.path.join(tmp_dir, _STORE_OFFSETS), offsets)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    try:
+        os.replace(tmp_dir, store_dir)
+    except OSError:  # another thread or process already wrote the same store
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return open_spectrum_store(store_dir)
+
+
+def get_spectrum_store(fh: BinaryIO, file_format: str, store_dir: str) -> SpectrumStore:
+    """Open the spectrum store at store_dir, converting the file first if the store does not exist yet."""
+    if os.path.exists(os.path.join(store_dir, _STORE_OFFSETS)):
+        try:
+            os.utime(store_dir)  # the mtime orders stores for prune_spectrum_stores
+        except OSError:
+            pass
+        return open_spectrum_store(store_dir)
+    return write_spectrum_store(fh, file_format, store_dir)
+
+
+def _dir_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file(follow_symlinks=False))
+
+
+def prune_spectrum_stores(root: str, max_bytes: int, keep: Optional[str] = None,
+                          tmp_max_age: float = 24 * 3600) -> None:
+    """
+    Delete the least recently used spectrum stores under root until they take at most max_bytes.
+
+    Stores that are still open stay readable (their files are memory-mapped), they are only converted again on the
+    next cache miss. Staging directories older than tmp_max_age seconds (left by killed conversions) are removed too.
+
+    :param root: Directory holding the stores.
+    :param max_bytes: Disk space the stores may take.
+    :param keep: Store that is never deleted (the one just opened).
+    :param tmp_max_age: Age in seconds after which a staging directory is considered abandoned.
+    """
+    keep = os.path.realpath(keep) if keep else None
+    stores = []
+    for entry in os.scandir(root):
+        try:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            mtime = entry.stat(follow_symlinks=False).st_mtime
+            if entry.name.endswith(_STORE_TMP_SUFFIX):
+                if time.time() - mtime > tmp_max_age:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            stores.append((mtime, entry.path, _dir_size(entry.path)))
+        except FileNotFoundError:  # removed by another thread or process meanwhile
+            continue
+
+    total = sum(size for _, _, size in stores)
+    for _, path, size in sorted(stores):
+        if total <= max_bytes:
+            break
+        if os.path.realpath(path) == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def format_scan_info(scan_info: ScanInfo) -> str:
+    """Short description of a scan for display."""
+    parts = [f"Scan {scan_info.scan}"]
+    if scan_info.precursor_mz is not None:
+        parts.append(f"m/z {scan_info.precursor_mz:.4f}")
+    if scan_info.charge is not None:
+        parts.append(f"z={scan_info.charge}")
+    if scan_info.rt is not None:
+        parts.append(f"RT {scan_info.rt / 60:.2f} min")
+    return " | ".join(parts)
@@ -0,0 +1,76 @@
+"""
+Import-time report of the app's modules (python -X importtime, run in a fresh interpreter).
+
+    python import_profile.py                      # the modules app.py imports
+    python import_profile.py annotation_util --depth 2 --top 30 -o import_times.csv
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import List, Optional
+
+import pandas as pd
+
+# the modules app.py imports, in import order
+APP_MODULES = ["numpy", "pandas", "streamlit_permalink", "streamlit", "peptacular", "streamlit_js_eval",
+               "annotation_util", "app_input", "constants", "color_util", "plot_util", "util"]
+
+_IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)$")
+
+
+def profile_imports(modules: List[str], python: str = sys.executable) -> pd.DataFrame:
+    """
+    Import modules in a fresh interpreter and return the import time of every module that got imported.
+
+    :param modules: Modules to import (in this order).
+    :param python: Interpreter to run.
+    :return: One row per imported module: module, depth (0 = top level), self_ms and cumulative_ms.
+    """
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append({
+                "module": module,
+                "depth": (len(indent) - 1) // 2,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            })
+    return pd.DataFrame(rows, columns=["module", "depth", "self_ms", "cumulative_ms"])
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Report the per module (cumulative) import time.")
+    parser.add_argument("modules", nargs="*", default=APP_MODULES, help="Modules to import (default: app.py's)")
+    parser.add_argument("--depth", type=int, default=0, help="Report modules up to this nesting depth")
+    parser.add_argument("--top", type=int, default=25, help="Number of modules to show")
+    parser.add_argument("-o", "--output", default=None, help="Also write the full report to this CSV file")
+    args = parser.parse_args(argv)
+
+    report_df = profile_imports(args.modules)
+    if args.output:
+        report_df.to_csv(args.output, index=False)
+
+    # includes the modules imported at interpreter startup (site, encodings, ...)
+    total_ms = report_df.loc[report_df["depth"] == 0, "cumulative_ms"].sum()
+    shown_df = report_df[report_df["depth"] <= args.depth].sort_values("cumulative_ms", ascending=False)
+    print(shown_df.head(args.top).to_string(index=False))
+    print(f"\n{len(report_df)} modules imported in {total_ms:.0f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Server-side permalink state: the page's query parameters and spectrum arrays stored under their content hash, so a
+link only carries the hash ('?state=<key>') and loading it is a single lookup (no decompressing or parsing).
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import constants
+from shortlink_util import encode_base62
+
+# query parameter holding a state key
+STATE_LINK_PARAM = "state"
+
+# spectra URL payload referring to a state's spectrum arrays ('KEY:<key>')
+STATE_SPECTRA_PREFIX = "KEY:"
+
+# query parameters that are not part of a state (the spectrum is stored as arrays)
+_EXCLUDED_PARAMS = {"spectra", STATE_LINK_PARAM}
+
+
+def _encode_arrays(mzs: np.ndarray, intensities: np.ndarray) -> bytes:
+    return np.stack([np.asarray(mzs, dtype=np.float64), np.asarray(intensities, dtype=np.float64)]).tobytes()
+
+
+def _decode_arrays(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    values = np.frombuffer(data, dtype=np.float64).reshape(2, -1)
+    return values[0].copy(), values[1].copy()
+
+
+class PermalinkStore:
+    """SQLite table of permalink states (query parameters and spectrum arrays), keyed by their content hash."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, params TEXT, spectra BLOB)")
+            self._local.connection = connection
+        return connection
+
+    def save(self, query_params: Dict[str, List[str]], mzs: np.ndarray, intensities: np.ndarray) -> str:
+        """
+        Store a state, the same parameters and spectrum always get the same key.
+
+        :param query_params: The page's query parameters (a list of values per parameter).
+        :param mzs: The spectrum's m/z values.
+        :param intensities: The spectrum's intensities.
+        :return: The state's key.
+        """
+        params = {k: [str(v) for v in values] for k, values in query_params.items() if k not in _EXCLUDED_PARAMS}
+        params_json = json.dumps(params, sort_keys=True, separators=(",", ":"))
+        spectra = _encode_arrays(mzs, intensities)
+
+        h = hashlib.blake2b(digest_size=12)
+        h.update(params_json.encode())
+        h.update(spectra)
+        key = encode_base62(h.digest())
+
+        self._connection().execute("INSERT OR IGNORE INTO states VALUES (?, ?, ?)", (key, params_json, spectra))
+        return key
+
+    def load_params(self, key: str) -> Optional[Dict[str, List[str]]]:
+        row = self._connection().execute("SELECT params FROM states WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_spectra(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        row = self._connection().execute("SELECT spectra FROM states WHERE key = ?", (key,)).fetchone()
+        return _decode_arrays(row[0]) if row else None
+
+
+@lru_cache(maxsize=None)
+def get_permalink_store() -> PermalinkStore:
+    return PermalinkStore(constants.PERMALINK_STORE_PATH)
@@ -40,8 +40,6 @@ def generate_annonated_spectra_plotly(df, scale='linear',
                                       hide_error_labels=True,
                                       bold_labels=True):
 
-    df = df.copy(deep=True)
-
     def format_label(row):
 
         if row['custom_label'] != None:
@@ -76,11 +74,12 @@ def generate_annonated_spectra_plotly(df, scale='linear',
         ion_label = f"<sup>{charge_str}</sup>{ion_type_str}"
         return ion_label
 
-    df['format_label'] = df.apply(format_label, axis=1)
-    df['format_group_label'] = df.apply(format_group_label, axis=1)
+    # keep the formatted labels as separate series so the (large) input frame is never copied
+    format_labels = df.apply(format_label, axis=1)
+    format_group_labels = df.apply(format_group_label, axis=1)
 
     if bold_labels:
-        df['format_label'] = df['format_label'].apply(lambda x: f"<b>{x}</b>")
+        format_labels = "<b>" + format_labels + "</b>"
 
     unique_color_labels = df['ion_group_label'].unique().tolist()
 
@@ -99,8 +98,9 @@ def generate_annonated_spectra_plotly(df, scale='linear',
 
     fig_spectra = go.Figure()
     for color_label in unique_color_labels:
-        tmp_df = df[df['ion_group_label'] == color_label]
-        format_group_label = tmp_df['format_group_label'].iloc[0]
+        label_mask = df['ion_group_label'] == color_label
+        tmp_df = df[label_mask]
+        format_group_label = format_group_labels[label_mask].iloc[0]
 
         
         # First add all the bar lines
@@ -123,9 +123,6 @@ def generate_annonated_spectra_plotly(df, scale='linear',
             first = False
 
 
-        tmp_df = df[df['ion_group_label'] == color_label]
-        format_group_label = tmp_df['format_group_label'].iloc[0]
-        
         if color_label == 'unassigned':
             hover_texts = tmp_df.apply(lambda
                                         row: f"m/z: {row['mz']}<br>Intensity: {row['intensity']}",
@@ -148,7 +145,7 @@ def generate_annonated_spectra_plotly(df, scale='linear',
             size=line_width,  # Invisible markers, just for positioning annotations
             color=tmp_df['color']
             ),
-            text=tmp_df['format_label'],
+            text=format_labels[label_mask],
             textposition='top center',
             textfont=dict(
                 size=text_size,  # Use textsize parameter
@@ -177,9 +174,10 @@ def generate_annonated_spectra_plotly(df, scale='linear',
         if color_label == 'unassigned':
             continue
 
-        tmp_df = df[df['ion_group_label'] == color_label]
+        label_mask = df['ion_group_label'] == color_label
+        tmp_df = df[label_mask]
         text_colors = tmp_df['color']
-        format_group_label = tmp_df['format_group_label'].iloc[0]
+        format_group_label = format_group_labels[label_mask].iloc[0]
 
         hover_texts = tmp_df.apply(lambda
                                        row: f"Charge: {row['charge']}<br>M/Z: {row['mz']}<br>Error: {row['error']}"
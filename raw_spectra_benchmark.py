@@ -0,0 +1,42 @@
+"""
+Benchmark of the RAW: spectra URL format (encode_raw_spectra / decode_raw_spectra).
+
+    python raw_spectra_benchmark.py                       # 1k, 10k and 50k peaks
+    python raw_spectra_benchmark.py --peaks 100000 --repeat 10
+"""
+
+import argparse
+import sys
+import timeit
+from typing import Optional
+
+import numpy as np
+
+from annotation_util import decode_raw_spectra, encode_raw_spectra
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark encoding and decoding RAW: spectra payloads.")
+    parser.add_argument("--peaks", type=int, nargs="+", default=[1_000, 10_000, 50_000], help="Spectrum sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (the best is reported)")
+    args = parser.parse_args(argv)
+
+    print(f"{'peaks':>8} {'encode ms':>10} {'decode ms':>10} {'payload chars':>14}")
+    for num_peaks in args.peaks:
+        rng = np.random.default_rng(0)
+        mzs = np.sort(rng.uniform(100, 2000, num_peaks))
+        intensities = rng.uniform(0, 1e6, num_peaks)
+        payload = encode_raw_spectra(mzs, intensities)
+
+        decoded_mzs, decoded_intensities = decode_raw_spectra(payload)
+        if not (np.array_equal(decoded_mzs, mzs) and np.array_equal(decoded_intensities, intensities)):
+            raise AssertionError(f"Round trip of {num_peaks} peaks is not exact")
+
+        encode_s = min(timeit.repeat(lambda: encode_raw_spectra(mzs, intensities), number=1, repeat=args.repeat))
+        decode_s = min(timeit.repeat(lambda: decode_raw_spectra(payload), number=1, repeat=args.repeat))
+        print(f"{num_peaks:>8} {encode_s * 1000:>10.1f} {decode_s * 1000:>10.1f} {len(payload):>14}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
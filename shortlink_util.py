@@ -0,0 +1,128 @@
+"""
+Permalink shortening: TinyURL (with a timeout) or a local short-link table that the app resolves itself.
+Shortening runs on a background thread and results are cached by URL, so a slow network never stalls a rerun.
+"""
+
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import urlsplit
+
+import constants
+
+SHORT_URL_MODES = ["tinyurl", "local"]
+
+# query parameter holding a local short-link code
+SHORT_LINK_PARAM = "s"
+
+_BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+def encode_base62(data: bytes) -> str:
+    number = int.from_bytes(data, "big")
+    chars = []
+    while number:
+        number, rem = divmod(number, 62)
+        chars.append(_BASE62[rem])
+    return "".join(reversed(chars)) or "0"
+
+
+class ShortLinkStore:
+    """SQLite table of short-link codes and the page query strings they stand for."""
+
+    def __init__(self, path: str, code_length: int = 8):
+        self.path = path
+        self.code_length = code_length
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS short_links (code TEXT PRIMARY KEY, query TEXT UNIQUE)")
+            self._local.connection = connection
+        return connection
+
+    def add(self, query: str) -> str:
+        """The code of a query string, the same query always gets the same code."""
+        connection = self._connection()
+        row = connection.execute("SELECT code FROM short_links WHERE query = ?", (query,)).fetchone()
+        if row is not None:
+            return row[0]
+
+        digest = encode_base62(hashlib.blake2b(query.encode(), digest_size=16).digest())
+        # lengthen the code on the (unlikely) collision with another query
+        for length in range(self.code_length, len(digest) + 1):
+            code = digest[:length]
+            connection.execute("INSERT OR IGNORE INTO short_links VALUES (?, ?)", (code, query))
+            row = connection.execute("SELECT query FROM short_links WHERE code = ?", (code,)).fetchone()
+            if row[0] == query:
+                return code
+        raise ValueError("Could not assign a short-link code")
+
+    def resolve(self, code: str) -> Optional[str]:
+        row = self._connection().execute("SELECT query FROM short_links WHERE code = ?", (code,)).fetchone()
+        return row[0] if row else None
+
+
+@lru_cache(maxsize=None)
+def get_short_link_store() -> ShortLinkStore:
+    return ShortLinkStore(constants.SHORT_LINK_STORE_PATH)
+
+
+def shorten_tinyurl(url: str, timeout: float = constants.SHORT_URL_TIMEOUT) -> str:
+    """Shorten a URL using TinyURL. Raises a requests.RequestException on failure."""
+    import requests
+
+    response = requests.get("https://tinyurl.com/api-create.php", params={"url": url}, timeout=timeout)
+    response.raise_for_status()
+    return response.text.strip()
+
+
+def shorten_local(url: str) -> str:
+    """Shorten a URL with the local short-link table (the app resolves '?s=<code>' itself)."""
+    parts = urlsplit(url)
+    code = get_short_link_store().add(parts.query)
+    return f"{parts.scheme}://{parts.netloc}{parts.path or '/'}?{SHORT_LINK_PARAM}={code}"
+
+
+def shorten(url: str, mode: str = constants.SHORT_URL_MODE) -> str:
+    if mode == "local":
+        return shorten_local(url)
+    if mode == "tinyurl":
+        return shorten_tinyurl(url)
+    raise ValueError(f"Unknown short URL mode: {mode} (valid: {', '.join(SHORT_URL_MODES)})")
+
+
+class ShortUrlCache:
+    """Shortens URLs on a background thread, the futures are cached (LRU) by mode and URL; failures are not."""
+
+    def __init__(self, max_entries: int = 256, workers: int = 4):
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="shorten_url")
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, url: str, mode: str = constants.SHORT_URL_MODE) -> Future:
+        key = (mode, url)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not (future.done() and future.exception() is not None):
+                self._futures.move_to_end(key)
+                return future
+
+            future = self._executor.submit(shorten, url, mode)
+            self._futures[key] = future
+            while len(self._futures) > self.max_entries:
+                self._futures.popitem(last=False)
+            return future
+
+
+@lru_cache(maxsize=None)
+def get_short_url_cache() -> ShortUrlCache:
+    return ShortUrlCache()
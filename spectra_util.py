@@ -0,0 +1,208 @@
+import multiprocessing
+import threading
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def centroid_spectra(mzs: np.ndarray, intensities: np.ndarray, mass_tolerance: float,
+                     min_intensity: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce profile mode data to centroids.
+
+    The profile is split into peaks at local minima and at m/z gaps wider than mass_tolerance. Each peak is
+    reported at its intensity weighted m/z with its apex intensity, peaks below min_intensity are dropped, and
+    centroids closer than mass_tolerance are merged. Already centroided data passes through (nearly) unchanged.
+
+    :param mzs: m/z values.
+    :param intensities: Intensity values.
+    :param mass_tolerance: Mass tolerance in Da (Th).
+    :param min_intensity: Minimum apex intensity of a peak.
+    :return: Centroided m/z and intensity arrays, sorted by m/z.
+    """
+
+    if len(mzs) == 0:
+        return mzs, intensities
+
+    if np.any(mzs[1:] < mzs[:-1]):
+        order = np.argsort(mzs, kind="stable")
+        mzs, intensities = mzs[order], intensities[order]
+
+    mzs = np.asarray(mzs, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+
+    # a new peak starts after an m/z gap or at a local minimum (the valley point goes to the right hand peak)
+    starts = np.zeros(len(mzs), dtype=bool)
+    starts[0] = True
+    starts[1:] = np.diff(mzs) > mass_tolerance
+    starts[1:-1] |= (intensities[1:-1] < intensities[:-2]) & (intensities[1:-1] <= intensities[2:])
+    peak_starts = np.flatnonzero(starts)
+
+    peak_sums = np.add.reduceat(intensities, peak_starts)
+    peak_apexes = np.maximum.reduceat(intensities, peak_starts)
+    keep = (peak_apexes >= min_intensity) & (peak_sums > 0)
+    if not keep.any():
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+
+    peak_sums, peak_apexes = peak_sums[keep], peak_apexes[keep]
+    peak_mzs = np.add.reduceat(mzs * intensities, peak_starts)[keep] / peak_sums
+
+    # merge neighbouring centroids within the mass tolerance
+    group_starts = np.flatnonzero(np.concatenate(([True], np.diff(peak_mzs) > mass_tolerance)))
+    if len(group_starts) == len(peak_mzs):
+        return peak_mzs, peak_apexes
+
+    group_sums = np.add.reduceat(peak_sums, group_starts)
+    group_mzs = np.add.reduceat(peak_mzs * peak_sums, group_starts) / group_sums
+    return group_mzs, np.maximum.reduceat(peak_apexes, group_starts)
+
+
+def retain_peaks(mzs: np.ndarray, intensities: np.ndarray, top_n: int, bottom_n: int = 0,
+                 window: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the top_n most intense and the bottom_n least intense peaks, either of the whole spectrum or of
+    every m/z window (e.g. top 10 per 100 Th).
+
+    :param mzs: m/z values.
+    :param intensities: Intensity values.
+    :param top_n: Number of most intense peaks to keep.
+    :param bottom_n: Number of least intense peaks to keep.
+    :param window: m/z window width (windows start at multiples of the width), 0 for the whole spectrum.
+    :return: Retained m/z and intensity arrays, in their original order.
+    """
+
+    n = len(mzs)
+    if window <= 0:
+        if top_n + bottom_n >= n:
+            return mzs, intensities
+
+        keep = np.zeros(n, dtype=bool)
+        if top_n > 0:
+            keep[np.argpartition(intensities, n - top_n)[n - top_n:]] = True
+        if bottom_n > 0:
+            keep[np.argpartition(intensities, bottom_n - 1)[:bottom_n]] = True
+        return mzs[keep], intensities[keep]
+
+    if n == 0:
+        return mzs, intensities
+
+    # rank peaks by intensity within their window: sort by (window, -intensity) and count from each window start
+    windows = np.floor(mzs / window).astype(np.int64)
+    order = np.lexsort((-intensities, windows))
+    sorted_windows = windows[order]
+    window_starts = np.flatnonzero(np.concatenate(([True], sorted_windows[1:] != sorted_windows[:-1])))
+    window_sizes = np.diff(np.append(window_starts, n))
+    ranks = np.arange(n) - np.repeat(window_starts, window_sizes)
+
+    keep = np.empty(n, dtype=bool)
+    keep[order] = (ranks < top_n) | (ranks >= np.repeat(window_sizes, window_sizes) - bottom_n)
+    return mzs[keep], intensities[keep]
+
+
+def _deconvolute_worker(mzs: np.ndarray, intensities: np.ndarray, tolerance: float, tolerance_type: str,
+                        charge_range: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    # only the worker processes import msdecon
+    from msdecon.deconvolution import deconvolute
+
+    peaks = deconvolute(list(zip(mzs.tolist(), intensities.tolist())),
+                        tolerance=tolerance,
+                        tolerance_type=tolerance_type,
+                        charge_range=charge_range)
+    return (np.array([p.base_peak.mz for p in peaks], dtype=np.float64),
+            np.array([p.total_intensity for p in peaks], dtype=np.float64))
+
+
+class _PoolTerminated(Exception):
+    """The pool was terminated (because of another call's timeout) before the call finished."""
+
+
+class _DeconvolutionPool:
+    """
+    Spawn process pool shared by all sessions. Terminating it (on a timeout) fails every other pending call at
+    once, instead of leaving their callers blocked until their own timeouts.
+    """
+
+    def __init__(self, processes: int):
+        # spawn: forking a process that runs (Streamlit) threads is not safe
+        self.pool = multiprocessing.get_context("spawn").Pool(processes)
+        self.terminated = False
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def run(self, func, args: tuple, timeout: Optional[float]):
+        """Run func in a worker, None if it does not finish within timeout. Raises _PoolTerminated."""
+        done = threading.Event()
+        with self._lock:
+            if self.terminated:
+                raise _PoolTerminated()
+            self._pending.add(done)
+        try:
+            result = self.pool.apply_async(func, args, callback=lambda _: done.set(),
+                                           error_callback=lambda _: done.set())
+            done.wait(timeout)
+        except ValueError:  # terminated in between ("Pool not running")
+            raise _PoolTerminated()
+        finally:
+            with self._lock:
+                self._pending.discard(done)
+
+        if result.ready():
+            return result.get()
+        if self.terminated:
+            raise _PoolTerminated()
+        return None
+
+    def terminate(self):
+        with self._lock:
+            self.terminated = True
+            pending, self._pending = self._pending, set()
+        for done in pending:
+            done.set()
+        self.pool.terminate()
+
+
+_deconvolution_pool: Optional[_DeconvolutionPool] = None
+_deconvolution_pool_lock = threading.Lock()
+
+
+def _get_deconvolution_pool(processes: int) -> _DeconvolutionPool:
+    global _deconvolution_pool
+    with _deconvolution_pool_lock:
+        if _deconvolution_pool is None or _deconvolution_pool.terminated:
+            _deconvolution_pool = _DeconvolutionPool(processes)
+        return _deconvolution_pool
+
+
+def deconvolute_spectra(mzs: np.ndarray, intensities: np.ndarray, tolerance: float, tolerance_type: str,
+                        charge_range: Tuple[int, int], timeout: Optional[float] = None,
+                        processes: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Deconvolute a spectrum with msdecon in a worker process.
+
+    If the worker does not finish within timeout (seconds) the worker pool is terminated, so a pathological
+    spectrum cannot keep a process busy, and a TimeoutError is raised. Other calls that were pending on the
+    terminated pool are resubmitted at once to a new pool (within their own remaining timeout).
+
+    :param mzs: m/z values.
+    :param intensities: Intensity values.
+    :param tolerance: Deconvolution tolerance.
+    :param tolerance_type: 'ppm' or 'da'.
+    :param charge_range: (min charge, max charge).
+    :param timeout: Timeout in seconds, None to wait indefinitely.
+    :param processes: Number of worker processes (used when the pool is created).
+    :return: m/z of the base peak and total intensity of every deconvoluted peak.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    args = (mzs, intensities, tolerance, tolerance_type, charge_range)
+    while True:
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+        pool = _get_deconvolution_pool(processes)
+        try:
+            result = pool.run(_deconvolute_worker, args, remaining)
+        except _PoolTerminated:
+            continue
+        if result is None:
+            pool.terminate()
+            raise TimeoutError(f"Deconvolution did not finish within {timeout} seconds")
+        return result
@@ -0,0 +1,38 @@
+import io
+
+import pandas as pd
+import pytest
+
+from batch_annotate import annotate_batch, get_batch_inputs, parse_param_value
+
+
+@pytest.mark.parametrize("value, default, expected", [
+    (3.0, 2, 3),
+    (float("nan"), 2, 2),
+    (1.0, False, True),
+    (5, 10.0, 5.0),
+    ("4", 2, 4),
+])
+def test_parse_param_value(value, default, expected):
+    parsed = parse_param_value(value, default)
+
+    assert parsed == expected and type(parsed) is type(expected)
+
+
+def test_parse_param_value_not_integral():
+    with pytest.raises(ValueError):
+        parse_param_value(2.5, 2)
+
+
+def test_blank_override_cell():
+    psm_df = pd.read_csv(io.StringIO("sequence,spectra,max_charge\n"
+                                     "PEPTIDE,100 1,3\n"
+                                     "PEPTIDE,100 1,\n"
+                                     "PEPTIDE,100 1,2\n"))
+    assert psm_df["max_charge"].dtype == float
+
+    charges = [get_batch_inputs(row, {}).max_charge for row in psm_df.to_dict(orient="records")]
+    assert charges == [3, 2, 2]
+
+    metrics_df = annotate_batch(psm_df)
+    assert metrics_df["error"].isna().all()
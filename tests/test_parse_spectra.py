@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from annotation_util import parse_spectra
+
+
+def test_parse():
+    mzs, intensities = parse_spectra("# header\n100.5 10\n\n200,2e3  # comment\n300.25\t.5\n")
+
+    np.testing.assert_array_equal(mzs, [100.5, 200.0, 300.25])
+    np.testing.assert_array_equal(intensities, [10.0, 2000.0, 0.5])
+
+
+@pytest.mark.parametrize("text", ["", "\n\n", " \t\n", "# only a comment\n\n# another"])
+def test_parse_no_peaks(text):
+    mzs, intensities = parse_spectra(text)
+
+    assert len(mzs) == 0 and len(intensities) == 0
+
+
+@pytest.mark.parametrize("text", ["100 5e", "1e 2", "100 5e+", "100 5-", "1.2.3 4", "100 5e\n200 3", "100", "1 2 3",
+                                  "100 abc", "100 inf"])
+def test_parse_invalid(text):
+    with pytest.raises(ValueError, match="line 1"):
+        parse_spectra(text)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from annotation_util import decode_raw_spectra, encode_raw_spectra
+
+
+@pytest.mark.parametrize("num_peaks", [0, 1, 2, 1000])
+def test_round_trip(num_peaks):
+    rng = np.random.default_rng(num_peaks)
+    mzs = np.sort(rng.uniform(100, 2000, num_peaks))
+    intensities = rng.uniform(0, 1e6, num_peaks)
+
+    decoded_mzs, decoded_intensities = decode_raw_spectra(encode_raw_spectra(mzs, intensities))
+
+    np.testing.assert_array_equal(decoded_mzs, mzs)
+    np.testing.assert_array_equal(decoded_intensities, intensities)
+
+
+def test_decode():
+    mzs, intensities = decode_raw_spectra("RAW:100.5:10;200:2e3;300.25:0")
+
+    np.testing.assert_array_equal(mzs, [100.5, 200.0, 300.25])
+    np.testing.assert_array_equal(intensities, [10.0, 2000.0, 0.0])
+
+
+@pytest.mark.parametrize("payload", [
+    "RAW:1:2:3;4",      # colon and semicolon totals match, the pairs do not
+    "RAW:1;2:3:4",
+    "RAW:1:2;3",
+    "RAW:1:2;",
+    "RAW:1:2;;3:4",
+    "RAW::;:",
+    "RAW:1:2;3:x",
+    "RAW:1:inf",
+    "RAW:1,2",
+    "RAW:1:5e",         # fromstring drops an unparsable tail of the last value
+    "RAW:1:5-",
+    "RAW:1:2e+",
+    "RAW:1:5e;2:3",
+    "RAW:1e:5;2:3",
+])
+def test_decode_malformed(payload):
+    with pytest.raises(ValueError):
+        decode_raw_spectra(payload)